@@ -0,0 +1,141 @@
+import copy
+import torch
+
+
+class BlockLogSumExp(torch.autograd.Function):
+    # block_lse[m, i, n] = logsumexp_j r[m, i] . r[n, j] / temperature over j != i when m == n, streamed in row blocks
+    # Only [block_size, M*B] logits exist at a time, the backward recomputes them instead of storing them
+    @staticmethod
+    def forward(ctx, representations, temperature, block_size):
+        n_reps, batch_size, _ = representations.size()
+        flat = representations.reshape(n_reps * batch_size, -1)
+        block_lse = torch.empty((n_reps * batch_size, n_reps), dtype=flat.dtype, device=flat.device)
+        for start in range(0, len(flat), block_size):
+            logits = BlockLogSumExp._get_logits(flat, start, block_size, temperature)
+            block_lse[start:start + len(logits)] = torch.logsumexp(logits.view(len(logits), n_reps, batch_size), dim=-1)
+        ctx.save_for_backward(representations, block_lse)
+        ctx.temperature = temperature
+        ctx.block_size = block_size
+        return block_lse.view(n_reps, batch_size, n_reps)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        representations, block_lse = ctx.saved_tensors
+        n_reps, batch_size, _ = representations.size()
+        flat = representations.reshape(n_reps * batch_size, -1)
+        grad_output = grad_output.reshape(n_reps * batch_size, n_reps)
+        grad_flat = torch.zeros_like(flat)
+        for start in range(0, len(flat), ctx.block_size):
+            logits = BlockLogSumExp._get_logits(flat, start, ctx.block_size, ctx.temperature)
+            end = start + len(logits)
+            # d lse / d logit is the softmax within each column block, weighted by the gradient of that block's lse
+            probs = torch.exp(logits.view(len(logits), n_reps, batch_size) - block_lse[start:end].unsqueeze(-1))
+            grad_logits = (probs * grad_output[start:end].unsqueeze(-1)).view(len(logits), -1) / ctx.temperature
+            grad_flat[start:end] += grad_logits @ flat
+            grad_flat += grad_logits.t() @ flat[start:end]
+        return grad_flat.view_as(representations), None, None
+
+    @staticmethod
+    def _get_logits(flat, start, block_size, temperature):
+        logits = flat[start:start + block_size] @ flat.t() / temperature
+        rows = torch.arange(len(logits), device=flat.device)
+        logits[rows, rows + start] = float('-inf')
+        return logits
+
+
+def get_block_lse(batch_representations, temperature, block_size=None):
+    n_reps = len(batch_representations)
+    batch_size = batch_representations[0].size(0)
+    if block_size is not None:
+        return BlockLogSumExp.apply(torch.stack(batch_representations, dim=0), temperature, block_size)
+    representations = torch.cat(batch_representations, dim=0)
+    logits = torch.mm(representations, representations.t()) / temperature
+    logits.fill_diagonal_(float('-inf'))
+    # block_lse[m, i, n] = logsumexp_j logits[(m, i), (n, j)]
+    return torch.logsumexp(logits.view(n_reps, batch_size, n_reps, batch_size), dim=3)
+
+
+def get_queue_lse(batch_representations, queue, temperature):
+    # queue_lse[m, i, n] = logsumexp_k r[m, i] . queue[n, k] / temperature, one representation of the queue at a time
+    representations = torch.stack(batch_representations, dim=0)
+    return torch.stack([torch.logsumexp(representations @ keys.t() / temperature, dim=-1) for keys in queue], dim=-1)
+
+
+class NegativeQueue:
+    # FIFO of past representations encoded by a momentum copy of the common encoder, used as extra negatives (MoCo)
+    # It is not a module on purpose, so checkpoints keep the plain GMC layout
+    def __init__(self, encoder, size, momentum):
+        self.encoder = copy.deepcopy(encoder)
+        for param in self.encoder.parameters():
+            param.requires_grad = False
+        self.size = size
+        self.momentum = momentum
+        self.keys = None
+        self.ptr = 0
+        self.filled = 0
+
+    def update_encoder(self, encoder):
+        with torch.no_grad():
+            for momentum_param, param in zip(self.encoder.parameters(), encoder.parameters()):
+                momentum_param.mul_(self.momentum).add_(param.detach(), alpha=1 - self.momentum)
+
+    def encode(self, features):
+        with torch.no_grad():
+            return torch.stack([self.encoder(h.detach()) for h in features], dim=0)
+
+    def get_keys(self):
+        # A copy, the loss still needs these keys in its backward after the current batch has been enqueued in place
+        if self.keys is None or self.filled == 0:
+            return None
+        return self.keys[:, :self.filled].clone()
+
+    def enqueue(self, keys):
+        if self.keys is None:
+            self.keys = keys.new_zeros((keys.size(0), self.size, keys.size(-1)))
+        n_keys = min(keys.size(1), self.size)
+        idx = (self.ptr + torch.arange(n_keys, device=keys.device)) % self.size
+        self.keys[:, idx] = keys[:, -n_keys:]
+        self.ptr = (self.ptr + n_keys) % self.size
+        self.filled = min(self.filled + n_keys, self.size)
+
+
+def infonce_loss(batch_representations, temperature, n_mods=None, block_size=None, queue=None):
+    # All anchor-modality terms come from one [M*B, M*B] similarity matrix, the last representation is the anchor
+    # The diagonal is excluded with -inf and denominators are logsumexps, so there are no masks, copies or exp overflows
+    # With a block_size the matrix is streamed in row blocks, so memory is O(M*B*block_size) instead of O((M*B)^2)
+    n_reps = len(batch_representations)
+    batch_size = batch_representations[0].size(0)
+    n_mods = n_reps - 1 if n_mods is None else n_mods
+    block_lse = get_block_lse(batch_representations, temperature, block_size)
+    if queue is not None:
+        # Queued keys of representation n extend the negatives of column block n
+        block_lse = torch.logaddexp(block_lse, get_queue_lse(batch_representations, queue, temperature))
+    representations = torch.stack(batch_representations, dim=0)
+    self_logits = (representations * representations).sum(dim=-1) / temperature
+
+    anchor = n_reps - 1
+    mods = torch.arange(n_mods, device=representations.device)
+    positives = (representations[anchor].unsqueeze(0) * representations[:n_mods]).sum(dim=-1) / temperature
+
+    cross_anchor = block_lse[anchor, :, mods].t()
+    cross_mod = block_lse[mods, :, anchor]
+    # Without a joint representation the anchor is also paired with itself, its diagonal then only appears once as a trivial pair
+    is_anchor = (mods == anchor).unsqueeze(-1)
+    cross_anchor = torch.where(is_anchor, torch.logaddexp(cross_anchor, self_logits[anchor]), cross_anchor)
+    cross_mod = torch.where(is_anchor, torch.logaddexp(cross_mod, self_logits[anchor]), cross_mod)
+
+    anchor_lse = torch.logaddexp(block_lse[anchor, :, anchor].unsqueeze(0), cross_anchor)
+    mod_lse = torch.logaddexp(cross_mod, block_lse[mods, :, mods])
+    return ((anchor_lse - positives) + (mod_lse - positives)).sum() / (2 * batch_size)
+
+
+def joints_as_negatives_infonce_loss(batch_representations, temperature, block_size=None, queue=None):
+    # Joints are the only negatives, so every modality shares the logsumexp over the off-diagonal joint similarities
+    joints = batch_representations[-1]
+    batch_size = joints.size(0)
+    joints_lse = get_block_lse([joints], temperature, block_size)[0, :, 0]
+    if queue is not None:
+        joints_lse = torch.logaddexp(joints_lse, get_queue_lse([joints], queue[-1:], temperature)[0, :, 0])
+    mods = torch.stack(batch_representations[:-1], dim=0)
+    positives = (joints.unsqueeze(0) * mods).sum(dim=-1) / temperature
+    return (joints_lse.unsqueeze(0) - positives).sum() / batch_size
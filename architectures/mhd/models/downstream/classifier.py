@@ -25,6 +25,15 @@ class MHDClassifier(nn.Module):
     def set_perturbation(self, perturbation):
         self.model.set_perturbation(perturbation)
 
+    def cache_features(self, x, target_modality):
+        if not hasattr(self.model, 'cache_features'):
+            return None
+        return self.model.cache_features(x, target_modality)
+
+    def set_feature_cache(self, feature_cache):
+        if hasattr(self.model, 'set_feature_cache'):
+            self.model.set_feature_cache(feature_cache)
+
     def forward(self, x, sample=True):
         if 'gmc' in self.model.name:
             z = self.model.encode(x, sample)
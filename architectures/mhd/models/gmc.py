@@ -3,11 +3,12 @@ import collections
 
 from pytorch_lightning import LightningModule
 from ..modules.gmc_networks import MHDImageProcessor, MHDTrajectoryProcessor, MHDSoundProcessor, MHDJointProcessor, MHDCommonEncoder
+from ...contrastive import NegativeQueue, infonce_loss, joints_as_negatives_infonce_loss
 
 
 # Code adapted from https://github.com/miguelsvasco/gmc
 class GMC(LightningModule):
-    def __init__(self, name, common_dim, exclude_modality, latent_dimension, infonce_temperature, loss_type="infonce"):
+    def __init__(self, name, common_dim, exclude_modality, latent_dimension, infonce_temperature, loss_type="infonce", infonce_block_size=None, queue_size=None, queue_momentum=0.999, shared_trunk=False):
         super(GMC, self).__init__()
         self.name = name
         self.loss_type = loss_type
@@ -15,6 +16,11 @@ class GMC(LightningModule):
         self.latent_dimension = latent_dimension
         self.exclude_modality = exclude_modality
         self.infonce_temperature = infonce_temperature
+        self.infonce_block_size = infonce_block_size
+        self.queue_size = queue_size
+        self.queue_momentum = queue_momentum
+        self.negative_queue = None
+        self.shared_trunk = shared_trunk
 
         self.image_processor = None
         self.trajectory_processor = None
@@ -27,19 +33,52 @@ class GMC(LightningModule):
             'joint': self.joint_processor,
         }
         self.encoder = None
+        self.feature_cache = None
 
     def set_modalities(self, exclude_modality):
         self.exclude_modality = exclude_modality
 
+    def set_feature_cache(self, feature_cache):
+        self.feature_cache = feature_cache
+
+    def cache_features(self, x, target_modality):
+        # Clean features of the branches the target modality does not flow into, reused by every point of a sweep over it
+        feature_cache = {'latents': {}, 'joint': {}}
+        with torch.no_grad():
+            if self.exclude_modality == 'none' or self.exclude_modality is None:
+                for key in ['image', 'trajectory']:
+                    if key != target_modality:
+                        feature_cache['joint'][key] = self._get_joint_features(key, x[key])
+            else:
+                for key in x.keys():
+                    if key != target_modality and key != self.exclude_modality:
+                        feature_cache['latents'][key] = self.encoder(self.processors[key](x[key]))
+        return feature_cache
+
+    def _get_joint_features(self, key, x_mod):
+        # With a shared trunk the joint processor consumes the features of the unimodal processors instead of its own copies
+        if self.shared_trunk:
+            return self.processors[key].get_features(x_mod)
+        return self.processors['joint'].get_features(key, x_mod)
+
+    def _get_joint_input(self, x):
+        cached = self.feature_cache['joint'] if self.feature_cache is not None else {}
+        return {key: cached[key] if key in cached else self._get_joint_features(key, x[key]) for key in ['image', 'trajectory']}
+
+    def _encode_modality(self, key, x):
+        if self.feature_cache is not None and key in self.feature_cache['latents']:
+            return self.feature_cache['latents'][key]
+        return self.encoder(self.processors[key](x[key]))
+
     def encode(self, x, sample=False):
         # If we have complete observations
         if self.exclude_modality == 'none' or self.exclude_modality is None:
-            return self.encoder(self.processors['joint'](x))
+            return self.encoder(self.processors['joint'](x, self._get_joint_input(x)))
         else:
             latent_representations = []
             for key in x.keys():
                 if key != self.exclude_modality:
-                    latent_representations.append(self.encoder(self.processors[key](x[key])))
+                    latent_representations.append(self._encode_modality(key, x))
 
             # Take the average of the latent representations
             if len(latent_representations) > 1:
@@ -48,96 +87,40 @@ class GMC(LightningModule):
                 latent = latent_representations[0]
             return latent
 
-    def forward(self, x):
-        # Forward pass through the modality specific encoders
-        batch_representations = []
+    def get_common_features(self, x):
+        # Forward pass through the modality specific processors
+        batch_features = []
+        trunk_features = {}
         for key in x.keys():
             if key != self.exclude_modality:
-                mod_representations = self.encoder(
-                    self.processors[key](x[key])
-                )
-                batch_representations.append(mod_representations)
+                if self.shared_trunk:
+                    trunk_features[key] = self.processors[key].get_features(x[key])
+                    batch_features.append(self.processors[key].projector(trunk_features[key]))
+                else:
+                    batch_features.append(self.processors[key](x[key]))
 
-        # Forward pass through the joint encoder
+        # Forward pass through the joint processor, reusing the unimodal features when the trunk is shared
         if self.exclude_modality == 'none' or self.exclude_modality is None:
-            joint_representation = self.encoder(self.processors['joint'](x))
-            batch_representations.append(joint_representation)
-        return batch_representations
+            batch_features.append(self.processors['joint'](x, trunk_features if self.shared_trunk else None))
+        return batch_features
+
+    def forward(self, x):
+        return [self.encoder(features) for features in self.get_common_features(x)]
+
+    def _get_negative_queue(self):
+        # Created at the first training step, once the encoder has its final dimensions and device
+        if self.negative_queue is None:
+            self.negative_queue = NegativeQueue(self.encoder, self.queue_size, self.queue_momentum)
+        return self.negative_queue
 
-    def infonce(self, batch_representations, batch_size):
-        joint_mod_loss_sum = 0
+    def infonce(self, batch_representations, batch_size, queue=None):
         mod_idx = len(batch_representations) - 1 if (self.exclude_modality == 'none' or self.exclude_modality is None) else len(batch_representations)
-        for mod in range(mod_idx):
-            # Negative pairs: everything that is not in the current joint-modality pair
-            out_joint_mod = torch.cat(
-                [batch_representations[-1], batch_representations[mod]], dim=0
-            )
-            # [2*B, 2*B]
-            sim_matrix_joint_mod = torch.exp(
-                torch.mm(out_joint_mod, out_joint_mod.t().contiguous()) / self.infonce_temperature
-            )
-            # Mask for remove diagonal that give trivial similarity, [2*B, 2*B]
-            mask_joint_mod = (
-                torch.ones_like(sim_matrix_joint_mod)
-                - torch.eye(2 * batch_size, device=sim_matrix_joint_mod.device)
-            ).bool()
-            # Remove 2*B diagonals and reshape to [2*B, 2*B-1]
-            sim_matrix_joint_mod = sim_matrix_joint_mod.masked_select(
-                mask_joint_mod
-            ).view(2 * batch_size, -1)
-
-            # Positive pairs: cosine loss joint-modality
-            pos_sim_joint_mod = torch.exp(
-                torch.sum(
-                    batch_representations[-1] * batch_representations[mod], dim=-1
-                )
-                / self.infonce_temperature
-            )
-            # [2*B]
-            pos_sim_joint_mod = torch.cat([pos_sim_joint_mod, pos_sim_joint_mod], dim=0)
-            loss_joint_mod = -torch.log(
-                pos_sim_joint_mod / sim_matrix_joint_mod.sum(dim=-1)
-            )
-            joint_mod_loss_sum += loss_joint_mod
-
-        loss = torch.mean(joint_mod_loss_sum)
+        loss = infonce_loss(batch_representations, self.infonce_temperature, mod_idx, self.infonce_block_size, queue)
         tqdm_dict = {"infonce_loss": loss}
         return loss, tqdm_dict
 
-    def infonce_with_joints_as_negatives(self, batch_representations, batch_size):
-        # Similarity among joints, [B, B]
-        sim_matrix_joints = torch.exp(
-            torch.mm(
-                batch_representations[-1], batch_representations[-1].t().contiguous()
-            )
-            / self.infonce_temperature
-        )
-        # Mask out the diagonals, [B, B]
-        mask_joints = (
-            torch.ones_like(sim_matrix_joints)
-            - torch.eye(batch_size, device=sim_matrix_joints.device)
-        ).bool()
-        # Remove diagonals and resize, [B, B-1]
-        sim_matrix_joints = sim_matrix_joints.masked_select(mask_joints).view(
-            batch_size, -1
-        )
-
-        # compute loss - for each pair joints-modality
-        # Cosine loss on positive pairs
-        joint_mod_loss_sum = 0
-        for mod in range(len(batch_representations) - 1):
-            pos_sim_joint_mod = torch.exp(
-                torch.sum(
-                    batch_representations[-1] * batch_representations[mod], dim=-1
-                )
-                / self.infonce_temperature
-            )
-            loss_joint_mod = -torch.log(
-                pos_sim_joint_mod / sim_matrix_joints.sum(dim=-1)
-            )
-            joint_mod_loss_sum += loss_joint_mod
-
-        loss = torch.mean(joint_mod_loss_sum)
+    def infonce_with_joints_as_negatives(self, batch_representations, batch_size, queue=None):
+        loss = joints_as_negatives_infonce_loss(batch_representations, self.infonce_temperature, self.infonce_block_size, queue)
         tqdm_dict = {"infonce_loss": loss}
         return loss, tqdm_dict
 
@@ -145,13 +128,25 @@ class GMC(LightningModule):
         batch_size = list(data.values())[0].size(dim=0)
 
         # Forward pass through the encoders
-        batch_representations = self.forward(data)
+        batch_features = self.get_common_features(data)
+        batch_representations = [self.encoder(features) for features in batch_features]
+
+        # Keys of the current batch come from the momentum encoder, they are only queued after the loss so they are never their own negatives
+        queue = None
+        if self.queue_size is not None:
+            negative_queue = self._get_negative_queue()
+            negative_queue.update_encoder(self.encoder)
+            keys = negative_queue.encode(batch_features)
+            queue = negative_queue.get_keys()
 
         # Compute contrastive loss
         if self.loss_type == "infonce_with_joints_as_negatives":
-            loss, tqdm_dict = self.infonce_with_joints_as_negatives(batch_representations, batch_size)
+            loss, tqdm_dict = self.infonce_with_joints_as_negatives(batch_representations, batch_size, queue)
         else:
-            loss, tqdm_dict = self.infonce(batch_representations, batch_size)
+            loss, tqdm_dict = self.infonce(batch_representations, batch_size, queue)
+
+        if self.queue_size is not None:
+            negative_queue.enqueue(keys)
         return loss, collections.Counter(tqdm_dict)
 
     def validation_step(self, data, labels):
@@ -168,13 +163,13 @@ class GMC(LightningModule):
 
 
 class MHDGMC(GMC):
-    def __init__(self, name, exclude_modality, common_dim, latent_dimension, infonce_temperature, loss_type="infonce"):
-        super(MHDGMC, self).__init__(name, common_dim, exclude_modality, latent_dimension, infonce_temperature, loss_type)
+    def __init__(self, name, exclude_modality, common_dim, latent_dimension, infonce_temperature, loss_type="infonce", infonce_block_size=None, queue_size=None, queue_momentum=0.999, shared_trunk=False):
+        super(MHDGMC, self).__init__(name, common_dim, exclude_modality, latent_dimension, infonce_temperature, loss_type, infonce_block_size, queue_size, queue_momentum, shared_trunk)
         self.common_dim = common_dim
         self.image_processor = MHDImageProcessor(common_dim=self.common_dim)
         self.trajectory_processor = MHDTrajectoryProcessor(common_dim=self.common_dim)
         self.sound_processor = MHDSoundProcessor(common_dim=self.common_dim)
-        self.joint_processor = MHDJointProcessor(common_dim=self.common_dim)
+        self.joint_processor = MHDJointProcessor(common_dim=self.common_dim, shared_trunk=shared_trunk)
         if exclude_modality == 'image':
             self.processors = {'trajectory': self.trajectory_processor, 'sound': self.sound_processor}
         elif exclude_modality == 'trajectory':
@@ -6,6 +6,7 @@ import torch.nn as nn
 
 from pytorch_lightning import LightningModule
 from ..modules.rgmc_networks import MHDImageProcessor, MHDTrajectoryProcessor, MHDJointProcessor, MHDCommonEncoder, OddOneOutNetwork
+from ...contrastive import infonce_loss, joints_as_negatives_infonce_loss
 
 
 class RGMC(LightningModule):
@@ -39,6 +40,7 @@ class RGMC(LightningModule):
         self.encoder = None
         self.o3n = None
         self.perturbation = None
+        self.feature_cache = None
 
     def set_modalities(self, exclude_modality):
         self.exclude_modality = exclude_modality
@@ -61,6 +63,27 @@ class RGMC(LightningModule):
             x = self.perturbation(x, y)
         return x, target_id
 
+    def set_feature_cache(self, feature_cache):
+        self.feature_cache = feature_cache
+
+    def cache_features(self, x, target_modality):
+        # Clean features of the branches the target modality does not flow into, reused by every point of a sweep over it
+        feature_cache = {'latents': {}, 'joint': {}}
+        with torch.no_grad():
+            for key in x.keys():
+                if key != target_modality and key != self.exclude_modality:
+                    feature_cache['latents'][key] = self.encoder(self.processors[key](x[key]))
+            if self.exclude_modality == 'none' or self.exclude_modality is None:
+                for key in ['image', 'trajectory']:
+                    if key != target_modality:
+                        feature_cache['joint'][key] = self.processors['joint'].get_features(key, x[key])
+        return feature_cache
+
+    def _encode_modality(self, key, x):
+        if self.feature_cache is not None and key in self.feature_cache['latents']:
+            return self.feature_cache['latents'][key]
+        return self.encoder(self.processors[key](x[key]))
+
     def encode(self, x, sample=False):
         batch_size = list(x.values())[0].size(dim=0)
         if sample is False and self.noise_factor != 0:
@@ -69,11 +92,11 @@ class RGMC(LightningModule):
         latent_representations = []
         for key in x.keys():
             if key != self.exclude_modality:
-                latent_representations.append(self.encoder(self.processors[key](x[key])))
+                latent_representations.append(self._encode_modality(key, x))
 
         if self.exclude_modality == 'none' or self.exclude_modality is None:
             mod_weights = self.o3n(latent_representations)
-            latent_representations.append(self.encoder(self.processors['joint'](x)))
+            latent_representations.append(self.encoder(self.processors['joint'](x, self.feature_cache['joint'] if self.feature_cache is not None else None)))
             latent_rep = latent_representations[0]
             latent_representations[0] = latent_representations[1]
             latent_representations[1] = latent_rep
@@ -85,106 +108,41 @@ class RGMC(LightningModule):
             return latent_representations[0]
 
     def forward(self, x, y):
+        batch_size = list(x.values())[0].size(dim=0)
+
+        # The perturbation does not depend on the representations, so it is applied first on a copy of the clean batch
+        x_perturbed, target_id = self.add_perturbation(dict(x), y)
+
+        # Forward pass through the modality specific encoders, clean and perturbed samples of a modality go through together
         clean_representations = []
+        batch_representations = []
         for key in x.keys():
             if key != self.exclude_modality:
-                mod_representations = self.encoder(
-                    self.processors[key](x[key])
-                )
-                clean_representations.append(mod_representations)
-        
+                if x_perturbed[key] is x[key]:
+                    # Untouched modalities share the clean representations
+                    mod_representations = self.encoder(self.processors[key](x[key]))
+                    clean_representations.append(mod_representations)
+                    batch_representations.append(mod_representations)
+                else:
+                    mod_representations = self.encoder(self.processors[key](torch.cat((x[key], x_perturbed[key]), dim=0)))
+                    clean_representations.append(mod_representations[:batch_size])
+                    batch_representations.append(mod_representations[batch_size:])
+
         # Forward pass through the joint encoder
         if self.exclude_modality == 'none' or self.exclude_modality is None:
             joint_representation = self.encoder(self.processors['joint'](x))
             clean_representations.append(joint_representation)
 
-        x, target_id = self.add_perturbation(x, y)
-
-        # Forward pass through the modality specific encoders
-        batch_representations = []
-        for key in x.keys():
-            if key != self.exclude_modality:
-                mod_representations = self.encoder(
-                    self.processors[key](x[key])
-                )
-                batch_representations.append(mod_representations)
-
         return clean_representations, batch_representations, target_id
 
     def infonce(self, batch_representations, batch_size):
-        joint_mod_loss_sum = 0
         mod_idx = len(batch_representations) - 1 if (self.exclude_modality == 'none' or self.exclude_modality is None) else len(batch_representations)
-        for mod in range(mod_idx):
-            # Negative pairs: everything that is not in the current joint-modality pair
-            out_joint_mod = torch.cat(
-                [batch_representations[-1], batch_representations[mod]], dim=0
-            )
-            # [2*B, 2*B]
-            sim_matrix_joint_mod = torch.exp(
-                torch.mm(out_joint_mod, out_joint_mod.t().contiguous()) / self.scales['infonce_temp']
-            )
-            # Mask for remove diagonal that give trivial similarity, [2*B, 2*B]
-            mask_joint_mod = (
-                torch.ones_like(sim_matrix_joint_mod)
-                - torch.eye(2 * batch_size, device=sim_matrix_joint_mod.device)
-            ).bool()
-            # Remove 2*B diagonals and reshape to [2*B, 2*B-1]
-            sim_matrix_joint_mod = sim_matrix_joint_mod.masked_select(
-                mask_joint_mod
-            ).view(2 * batch_size, -1)
-
-            # Positive pairs: cosine loss joint-modality
-            pos_sim_joint_mod = torch.exp(
-                torch.sum(
-                    batch_representations[-1] * batch_representations[mod], dim=-1
-                )
-                / self.scales['infonce_temp']
-            )
-            # [2*B]
-            pos_sim_joint_mod = torch.cat([pos_sim_joint_mod, pos_sim_joint_mod], dim=0)
-            loss_joint_mod = -torch.log(
-                pos_sim_joint_mod / sim_matrix_joint_mod.sum(dim=-1)
-            )
-            joint_mod_loss_sum += loss_joint_mod
-
-        loss = torch.mean(joint_mod_loss_sum)
+        loss = infonce_loss(batch_representations, self.scales['infonce_temp'], mod_idx)
         tqdm_dict = {"infonce_loss": loss}
         return loss, tqdm_dict
 
     def infonce_with_joints_as_negatives(self, batch_representations, batch_size):
-        # Similarity among joints, [B, B]
-        sim_matrix_joints = torch.exp(
-            torch.mm(
-                batch_representations[-1], batch_representations[-1].t().contiguous()
-            )
-            / self.scales['infonce_temp']
-        )
-        # Mask out the diagonals, [B, B]
-        mask_joints = (
-            torch.ones_like(sim_matrix_joints)
-            - torch.eye(batch_size, device=sim_matrix_joints.device)
-        ).bool()
-        # Remove diagonals and resize, [B, B-1]
-        sim_matrix_joints = sim_matrix_joints.masked_select(mask_joints).view(
-            batch_size, -1
-        )
-
-        # compute loss - for each pair joints-modality
-        # Cosine loss on positive pairs
-        joint_mod_loss_sum = 0
-        for mod in range(len(batch_representations) - 1):
-            pos_sim_joint_mod = torch.exp(
-                torch.sum(
-                    batch_representations[-1] * batch_representations[mod], dim=-1
-                )
-                / self.scales['infonce_temp']
-            )
-            loss_joint_mod = -torch.log(
-                pos_sim_joint_mod / sim_matrix_joints.sum(dim=-1)
-            )
-            joint_mod_loss_sum += loss_joint_mod
-
-        loss = torch.mean(joint_mod_loss_sum)
+        loss = joints_as_negatives_infonce_loss(batch_representations, self.scales['infonce_temp'])
         tqdm_dict = {"infonce_loss": loss}
         return loss, tqdm_dict
     
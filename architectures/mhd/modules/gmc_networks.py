@@ -45,10 +45,12 @@ class MHDImageProcessor(nn.Module):
         self.projector = nn.Linear(128 * 7 * 7,  common_dim)
         self.common_dim = common_dim
 
-    def forward(self, x):
+    def get_features(self, x):
         h = self.image_features(x)
-        h = h.view(h.size(0), -1)
-        return self.projector(h)
+        return h.view(h.size(0), -1)
+
+    def forward(self, x):
+        return self.projector(self.get_features(x))
 
 
 class MHDTrajectoryProcessor(nn.Module):
@@ -67,9 +69,11 @@ class MHDTrajectoryProcessor(nn.Module):
         self.projector = nn.Linear(512,  common_dim)
         self.common_dim = common_dim
 
+    def get_features(self, x):
+        return self.trajectory_features(x)
+
     def forward(self, x):
-        h = self.trajectory_features(x)
-        return self.projector(h)
+        return self.projector(self.get_features(x))
     
 
 class MHDSoundProcessor(nn.Module):
@@ -96,43 +100,54 @@ class MHDSoundProcessor(nn.Module):
         self.projector = nn.Linear(2048,  common_dim)
         self.common_dim = common_dim
 
-    def forward(self, x):
+    def get_features(self, x):
         h = self.sound_features(x)
-        h = h.view(h.size(0), -1)
-        return self.projector(h)
+        return h.view(h.size(0), -1)
+
+    def forward(self, x):
+        return self.projector(self.get_features(x))
 
 
 class MHDJointProcessor(nn.Module):
-    def __init__(self, common_dim):
+    def __init__(self, common_dim, shared_trunk=False):
         super(MHDJointProcessor, self).__init__()
         self.common_dim = common_dim
-        self.img_features = nn.Sequential(
-            nn.Conv2d(1, 64, 4, 2, 1, bias=False),
-            nn.GELU(),
-            nn.Conv2d(64, 128, 4, 2, 1, bias=False),
-            nn.GELU(),
-        )
-
-        self.trajectory_features = nn.Sequential(
-            nn.Linear(200, 512),
-            nn.GELU(),
-            nn.Linear(512, 512),
-            nn.GELU(),
-        )
+        self.shared_trunk = shared_trunk
+        # With a shared trunk the joint processor only owns its projector and always receives the unimodal features
+        if not shared_trunk:
+            self.img_features = nn.Sequential(
+                nn.Conv2d(1, 64, 4, 2, 1, bias=False),
+                nn.GELU(),
+                nn.Conv2d(64, 128, 4, 2, 1, bias=False),
+                nn.GELU(),
+            )
+
+            self.trajectory_features = nn.Sequential(
+                nn.Linear(200, 512),
+                nn.GELU(),
+                nn.Linear(512, 512),
+                nn.GELU(),
+            )
         self.projector = nn.Linear(128 * 7 * 7 + 512, common_dim)
 
     def set_common_dim(self, common_dim):
         self.projector = nn.Linear(128 * 7 * 7 + 512,  common_dim)
         self.common_dim = common_dim
 
-    def forward(self, x):
-        x_img, x_trajectory = x['image'], x['trajectory']
+    def get_features(self, key, x_mod):
+        if key == 'image':
+            h_img = self.img_features(x_mod)
+            return h_img.view(h_img.size(0), -1)
+        return self.trajectory_features(x_mod)
+
+    def forward(self, x, features=None):
+        # Cached features of unperturbed modalities skip their branch
+        features = {} if features is None else features
 
         # Image
-        h_img = self.img_features(x_img)
-        h_img = h_img.view(h_img.size(0), -1)
+        h_img = features['image'] if 'image' in features else self.get_features('image', x['image'])
 
         # Trajectory
-        h_trajectory = self.trajectory_features(x_trajectory)
+        h_trajectory = features['trajectory'] if 'trajectory' in features else self.get_features('trajectory', x['trajectory'])
 
         return self.projector(torch.cat((h_img, h_trajectory), dim=-1))
\ No newline at end of file
@@ -126,15 +126,21 @@ class MHDJointProcessor(nn.Module):
         self.projector = nn.Linear(self.image_dim + self.traj_dim, common_dim)
         self.common_dim = common_dim
 
-    def forward(self, x):
-        x_img, x_trajectory = x['image'], x['trajectory']
+    def get_features(self, key, x_mod):
+        if key == 'image':
+            h_img = self.img_features(x_mod)
+            return h_img.view(h_img.size(0), -1)
+        return self.trajectory_features(x_mod)
+
+    def forward(self, x, features=None):
+        # Cached features of unperturbed modalities skip their branch
+        features = {} if features is None else features
 
         # Image
-        h_img = self.img_features(x_img)
-        h_img = h_img.view(h_img.size(0), -1)
+        h_img = features['image'] if 'image' in features else self.get_features('image', x['image'])
 
         # Trajectory
-        h_trajectory = self.trajectory_features(x_trajectory)
+        h_trajectory = features['trajectory'] if 'trajectory' in features else self.get_features('trajectory', x['trajectory'])
 
         return self.projector(torch.cat((h_img, h_trajectory), dim=-1))
     
@@ -10,6 +10,7 @@ from ..modules.dgmc_networks import (
     MSJointProcessor, MSJointDecoder,
     MSCommonEncoder, MSCommonDecoder
 )
+from ...contrastive import infonce_loss, joints_as_negatives_infonce_loss
 
 
 class DGMC(LightningModule):
@@ -115,79 +116,13 @@ class DGMC(LightningModule):
         return batch_representations
 
     def infonce(self, batch_representations, batch_size):
-        joint_mod_loss_sum = 0
         mod_idx = len(batch_representations) - 1 if (self.exclude_modality == 'none' or self.exclude_modality is None) else len(batch_representations)
-        for mod in range(mod_idx):
-            # Negative pairs: everything that is not in the current joint-modality pair
-            out_joint_mod = torch.cat(
-                [batch_representations[-1], batch_representations[mod]], dim=0
-            )
-            # [2*B, 2*B]
-            sim_matrix_joint_mod = torch.exp(
-                torch.mm(out_joint_mod, out_joint_mod.t().contiguous()) / self.scales['infonce_temp']
-            )
-            # Mask for remove diagonal that give trivial similarity, [2*B, 2*B]
-            mask_joint_mod = (
-                torch.ones_like(sim_matrix_joint_mod)
-                - torch.eye(2 * batch_size, device=sim_matrix_joint_mod.device)
-            ).bool()
-            # Remove 2*B diagonals and reshape to [2*B, 2*B-1]
-            sim_matrix_joint_mod = sim_matrix_joint_mod.masked_select(
-                mask_joint_mod
-            ).view(2 * batch_size, -1)
-
-            # Positive pairs: cosine loss joint-modality
-            pos_sim_joint_mod = torch.exp(
-                torch.sum(
-                    batch_representations[-1] * batch_representations[mod], dim=-1
-                )
-                / self.scales['infonce_temp']
-            )
-            # [2*B]
-            pos_sim_joint_mod = torch.cat([pos_sim_joint_mod, pos_sim_joint_mod], dim=0)
-            loss_joint_mod = -torch.log(
-                pos_sim_joint_mod / sim_matrix_joint_mod.sum(dim=-1)
-            )
-            joint_mod_loss_sum += loss_joint_mod
-
-        loss = torch.mean(joint_mod_loss_sum)
+        loss = infonce_loss(batch_representations, self.scales['infonce_temp'], mod_idx)
         tqdm_dict = {"infonce_loss": loss}
         return loss, tqdm_dict
 
     def infonce_with_joints_as_negatives(self, batch_representations, batch_size):
-        # Similarity among joints, [B, B]
-        sim_matrix_joints = torch.exp(
-            torch.mm(
-                batch_representations[-1], batch_representations[-1].t().contiguous()
-            )
-            / self.scales['infonce_temp']
-        )
-        # Mask out the diagonals, [B, B]
-        mask_joints = (
-            torch.ones_like(sim_matrix_joints)
-            - torch.eye(batch_size, device=sim_matrix_joints.device)
-        ).bool()
-        # Remove diagonals and resize, [B, B-1]
-        sim_matrix_joints = sim_matrix_joints.masked_select(mask_joints).view(
-            batch_size, -1
-        )
-
-        # compute loss - for each pair joints-modality
-        # Cosine loss on positive pairs
-        joint_mod_loss_sum = 0
-        for mod in range(len(batch_representations) - 1):
-            pos_sim_joint_mod = torch.exp(
-                torch.sum(
-                    batch_representations[-1] * batch_representations[mod], dim=-1
-                )
-                / self.scales['infonce_temp']
-            )
-            loss_joint_mod = -torch.log(
-                pos_sim_joint_mod / sim_matrix_joints.sum(dim=-1)
-            )
-            joint_mod_loss_sum += loss_joint_mod
-
-        loss = torch.mean(joint_mod_loss_sum)
+        loss = joints_as_negatives_infonce_loss(batch_representations, self.scales['infonce_temp'])
         tqdm_dict = {"infonce_loss": loss}
         return loss, tqdm_dict
 
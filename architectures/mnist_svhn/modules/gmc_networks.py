@@ -48,10 +48,12 @@ class MSMNISTProcessor(nn.Module):
         self.projector = nn.Linear(self.dim,  common_dim)
         self.common_dim = common_dim
 
-    def forward(self, x):
+    def get_features(self, x):
         h = self.mnist_features(x)
-        h = h.view(h.size(0), -1)
-        return self.projector(h)
+        return h.view(h.size(0), -1)
+
+    def forward(self, x):
+        return self.projector(self.get_features(x))
 
 
 class MSSVHNProcessor(nn.Module):
@@ -73,48 +75,59 @@ class MSSVHNProcessor(nn.Module):
         self.projector = nn.Linear(self.dim, common_dim)
         self.common_dim = common_dim
 
-    def forward(self, x):
+    def get_features(self, x):
         h = self.svhn_features(x)
-        h = h.view(h.size(0), -1)
-        return self.projector(h)
+        return h.view(h.size(0), -1)
+
+    def forward(self, x):
+        return self.projector(self.get_features(x))
 
 
 class MSJointProcessor(nn.Module):
-    def __init__(self, common_dim, mnist_dim, svhn_dim):
+    def __init__(self, common_dim, mnist_dim, svhn_dim, shared_trunk=False):
         super(MSJointProcessor, self).__init__()
         self.svhn_dim = svhn_dim
         self.mnist_dim = mnist_dim
         self.common_dim = common_dim
-        self.mnist_features = nn.Sequential(
-            nn.Conv2d(1, filter_base * 2, 4, 2, 1, bias=False),
-            nn.GELU(),
-            nn.Conv2d(filter_base * 2, filter_base * 4, 4, 2, 1, bias=False),
-            nn.GELU(),
-        )
-
-        self.svhn_features = nn.Sequential(
-            nn.Conv2d(3, filter_base, 4, 2, 1),
-            nn.GELU(),
-            nn.Conv2d(filter_base, filter_base * 2, 4, 2, 1, bias=False),
-            nn.GELU(),
-            nn.Conv2d(filter_base * 2, filter_base * 4, 4, 2, 1, bias=False),
-            nn.GELU(),
-        )
+        self.shared_trunk = shared_trunk
+        # With a shared trunk the joint processor only owns its projector and always receives the unimodal features
+        if not shared_trunk:
+            self.mnist_features = nn.Sequential(
+                nn.Conv2d(1, filter_base * 2, 4, 2, 1, bias=False),
+                nn.GELU(),
+                nn.Conv2d(filter_base * 2, filter_base * 4, 4, 2, 1, bias=False),
+                nn.GELU(),
+            )
+
+            self.svhn_features = nn.Sequential(
+                nn.Conv2d(3, filter_base, 4, 2, 1),
+                nn.GELU(),
+                nn.Conv2d(filter_base, filter_base * 2, 4, 2, 1, bias=False),
+                nn.GELU(),
+                nn.Conv2d(filter_base * 2, filter_base * 4, 4, 2, 1, bias=False),
+                nn.GELU(),
+            )
         self.projector = nn.Linear(self.mnist_dim + self.svhn_dim, common_dim)
 
     def set_common_dim(self, common_dim):
         self.projector = nn.Linear(self.mnist_dim + self.svhn_dim, common_dim)
         self.common_dim = common_dim
 
-    def forward(self, x):
-        x_mnist, x_svhn = x['mnist'], x['svhn']
+    def get_features(self, key, x_mod):
+        if key == 'mnist':
+            h_mnist = self.mnist_features(x_mod)
+            return h_mnist.view(h_mnist.size(0), -1)
+        h_svhn = self.svhn_features(x_mod)
+        return h_svhn.view(h_svhn.size(0), -1)
+
+    def forward(self, x, features=None):
+        # Cached features of unperturbed modalities skip their branch
+        features = {} if features is None else features
 
         # MNIST
-        h_mnist = self.mnist_features(x_mnist)
-        h_mnist = h_mnist.view(h_mnist.size(0), -1)
+        h_mnist = features['mnist'] if 'mnist' in features else self.get_features('mnist', x['mnist'])
 
         # SVHN
-        h_svhn = self.svhn_features(x_svhn)
-        h_svhn = h_svhn.view(h_svhn.size(0), -1)
+        h_svhn = features['svhn'] if 'svhn' in features else self.get_features('svhn', x['svhn'])
 
         return self.projector(torch.cat((h_mnist, h_svhn), dim=-1))
\ No newline at end of file
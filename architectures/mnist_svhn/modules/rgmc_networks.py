@@ -107,16 +107,22 @@ class MSJointProcessor(nn.Module):
         self.projector = nn.Linear(self.mnist_dim + self.svhn_dim, common_dim)
         self.common_dim = common_dim
 
-    def forward(self, x):
-        x_mnist, x_svhn = x['mnist'], x['svhn']
+    def get_features(self, key, x_mod):
+        if key == 'mnist':
+            h_mnist = self.mnist_features(x_mod)
+            return h_mnist.view(h_mnist.size(0), -1)
+        h_svhn = self.svhn_features(x_mod)
+        return h_svhn.view(h_svhn.size(0), -1)
+
+    def forward(self, x, features=None):
+        # Cached features of unperturbed modalities skip their branch
+        features = {} if features is None else features
 
         # MNIST
-        h_mnist = self.mnist_features(x_mnist)
-        h_mnist = h_mnist.view(h_mnist.size(0), -1)
+        h_mnist = features['mnist'] if 'mnist' in features else self.get_features('mnist', x['mnist'])
 
         # SVHN
-        h_svhn = self.svhn_features(x_svhn)
-        h_svhn = h_svhn.view(h_svhn.size(0), -1)
+        h_svhn = features['svhn'] if 'svhn' in features else self.get_features('svhn', x['svhn'])
 
         return self.projector(torch.cat((h_mnist, h_svhn), dim=-1))
     
@@ -3,6 +3,7 @@ import collections
 
 from pytorch_lightning import LightningModule
 from ..modules.gmc_networks import AffectGRUEncoder, AffectJointProcessor, AffectEncoder
+from ...contrastive import infonce_loss, joints_as_negatives_infonce_loss
 
 
 # Code adapted from https://github.com/miguelsvasco/gmc
@@ -29,10 +30,34 @@ class SuperGMC(LightningModule):
         }
 
         self.encoder = None
+        self.feature_cache = None
 
     def set_modalities(self, exclude_modality):
         self.exclude_modality = exclude_modality
 
+    def set_feature_cache(self, feature_cache):
+        self.feature_cache = feature_cache
+
+    def set_sequence_padding(self, padding):
+        self.joint_processor.set_padding(padding)
+
+    def cache_features(self, x, target_modality):
+        # Clean latents of the unperturbed modalities, reused by every point of a sweep over the target one
+        # The cross-modal transformers of the joint processor mix every modality, so the joint path is always recomputed
+        feature_cache = {'latents': {}}
+        if self.exclude_modality == 'none' or self.exclude_modality is None:
+            return feature_cache
+        with torch.no_grad():
+            for key in x.keys():
+                if key != target_modality and key != self.exclude_modality:
+                    feature_cache['latents'][key] = self.encoder(self.processors[key](x[key]))
+        return feature_cache
+
+    def _encode_modality(self, key, x):
+        if self.feature_cache is not None and key in self.feature_cache['latents']:
+            return self.feature_cache['latents'][key]
+        return self.encoder(self.processors[key](x[key]))
+
     def encode(self, x, sample=False):
         # If we have complete observations
         if self.exclude_modality == 'none' or self.exclude_modality is None:
@@ -41,7 +66,7 @@ class SuperGMC(LightningModule):
             latent_representations = []
             for key in x.keys():
                 if key != self.exclude_modality:
-                    latent_representations.append(self.encoder(self.processors[key](x[key])))
+                    latent_representations.append(self._encode_modality(key, x))
 
             # Take the average of the latent representations
             if len(latent_representations) > 1:
@@ -67,79 +92,13 @@ class SuperGMC(LightningModule):
         return batch_representations
 
     def infonce(self, batch_representations, batch_size):
-        joint_mod_loss_sum = 0
         mod_idx = len(batch_representations) - 1 if (self.exclude_modality == 'none' or self.exclude_modality is None) else len(batch_representations)
-        for mod in range(mod_idx):
-            # Negative pairs: everything that is not in the current joint-modality pair
-            out_joint_mod = torch.cat(
-                [batch_representations[-1], batch_representations[mod]], dim=0
-            )
-            # [2*B, 2*B]
-            sim_matrix_joint_mod = torch.exp(
-                torch.mm(out_joint_mod, out_joint_mod.t().contiguous()) / self.infonce_temperature
-            )
-            # Mask for remove diagonal that give trivial similarity, [2*B, 2*B]
-            mask_joint_mod = (
-                torch.ones_like(sim_matrix_joint_mod)
-                - torch.eye(2 * batch_size, device=sim_matrix_joint_mod.device)
-            ).bool()
-            # Remove 2*B diagonals and reshape to [2*B, 2*B-1]
-            sim_matrix_joint_mod = sim_matrix_joint_mod.masked_select(
-                mask_joint_mod
-            ).view(2 * batch_size, -1)
-
-            # Positive pairs: cosine loss joint-modality
-            pos_sim_joint_mod = torch.exp(
-                torch.sum(
-                    batch_representations[-1] * batch_representations[mod], dim=-1
-                )
-                / self.infonce_temperature
-            )
-            # [2*B]
-            pos_sim_joint_mod = torch.cat([pos_sim_joint_mod, pos_sim_joint_mod], dim=0)
-            loss_joint_mod = -torch.log(
-                pos_sim_joint_mod / sim_matrix_joint_mod.sum(dim=-1)
-            )
-            joint_mod_loss_sum += loss_joint_mod
-
-        loss = torch.mean(joint_mod_loss_sum)
+        loss = infonce_loss(batch_representations, self.infonce_temperature, mod_idx)
         tqdm_dict = {"infonce_loss": loss}
         return loss, tqdm_dict
 
     def infonce_with_joints_as_negatives(self, batch_representations, batch_size):
-        # Similarity among joints, [B, B]
-        sim_matrix_joints = torch.exp(
-            torch.mm(
-                batch_representations[-1], batch_representations[-1].t().contiguous()
-            )
-            / self.infonce_temperature
-        )
-        # Mask out the diagonals, [B, B]
-        mask_joints = (
-            torch.ones_like(sim_matrix_joints)
-            - torch.eye(batch_size, device=sim_matrix_joints.device)
-        ).bool()
-        # Remove diagonals and resize, [B, B-1]
-        sim_matrix_joints = sim_matrix_joints.masked_select(mask_joints).view(
-            batch_size, -1
-        )
-
-        # compute loss - for each pair joints-modality
-        # Cosine loss on positive pairs
-        joint_mod_loss_sum = 0
-        for mod in range(len(batch_representations) - 1):
-            pos_sim_joint_mod = torch.exp(
-                torch.sum(
-                    batch_representations[-1] * batch_representations[mod], dim=-1
-                )
-                / self.infonce_temperature
-            )
-            loss_joint_mod = -torch.log(
-                pos_sim_joint_mod / sim_matrix_joints.sum(dim=-1)
-            )
-            joint_mod_loss_sum += loss_joint_mod
-
-        loss = torch.mean(joint_mod_loss_sum)
+        loss = joints_as_negatives_infonce_loss(batch_representations, self.infonce_temperature)
         tqdm_dict = {"infonce_loss": loss}
         return loss, tqdm_dict
 
@@ -37,6 +37,7 @@ class AffectJointProcessor(torch.nn.Module):
     def __init__(self, common_dim, scenario='mosei'):
         super(AffectJointProcessor, self).__init__()
         self.common_dim = common_dim
+        self.padding = None
         if scenario == 'mosei':
             # Language
             self.proj_l = nn.Conv1d(300, 30, kernel_size=1, padding=0, bias=False)
@@ -83,11 +84,18 @@ class AffectJointProcessor(torch.nn.Module):
         self.common_dim = common_dim
         self.projector = nn.Linear(60*3, common_dim)
 
+    def set_padding(self, padding):
+        self.padding = padding
+
     def forward(self, x):
         x_l, x_a, x_v = x['text'], x['audio'], x['vision']
         """
         text, audio, and vision should have dimension [batch_size, seq_len, n_features]
         """
+        # Length-bucketed batches come with the leading timesteps that are padding for all their samples, attention skips them
+        if self.padding is not None:
+            x_l, x_a, x_v = x_l[:, self.padding:], x_a[:, self.padding:], x_v[:, self.padding:]
+
         x_l = F.dropout(x_l.transpose(1, 2), p=0.25, training=self.training)
         x_a = x_a.transpose(1, 2)
         x_v = x_v.transpose(1, 2)
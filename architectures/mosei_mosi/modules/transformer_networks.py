@@ -403,8 +403,7 @@ def buffered_future_mask(tensor, tensor2=None):
     if tensor2 is not None:
         dim2 = tensor2.size(0)
     future_mask = torch.triu(fill_with_neg_inf(torch.ones(dim1, dim2)), 1 + abs(dim2 - dim1))
-    if tensor.is_cuda:
-        future_mask = future_mask.cuda()
+    future_mask = future_mask.to(tensor.device)
     return future_mask[:dim1, :dim2]
 
 
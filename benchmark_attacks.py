@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import torch
+import argparse
+import resource
+import multiprocessing
+
+from architectures import MHDGMC, MSGMC, AffectGMC, MHDClassifier, MSClassifier, MMClassifier
+from utils.setup import setup_attack
+from utils.command_parser import (
+    COMMON_DIM_DEFAULT, LATENT_DIM_DEFAULT, INFONCE_TEMPERATURE_DEFAULT, NOISE_STD_DEFAULT, ADV_EPSILON_DEFAULT, ADV_ALPHA_DEFAULT,
+    ADV_STEPS_DEFAULT, ADV_KAPPA_DEFAULT, ADV_LR_DEFAULT, ADV_RESTARTS_DEFAULT, ADV_SEARCH_STEPS_DEFAULT
+)
+
+
+BENCHMARK_DATASETS = {
+    'mhd': {'image': (1, 28, 28), 'trajectory': (200,)},
+    'mnist_svhn': {'mnist': (1, 28, 28), 'svhn': (3, 32, 32)},
+    'mosei': {'text': (50, 300), 'audio': (50, 74), 'vision': (50, 35)}
+}
+BENCHMARK_ATTACKS = ['gaussian_noise', 'fgsm', 'bim', 'pgd', 'cw']
+BATCH_SIZES_DEFAULT = [32, 128, 512]
+REPEATS_DEFAULT = 3
+RESULTS_PATH_DEFAULT = os.path.join("results", "benchmarks", "attacks.json")
+
+
+def setup_benchmark_classifier(dataset_name, device):
+    # Randomly initialized classifiers with the default dimensions, only their shapes matter for the timings
+    if dataset_name == 'mhd':
+        clf = MHDClassifier(LATENT_DIM_DEFAULT, MHDGMC('gmc', 'none', COMMON_DIM_DEFAULT, LATENT_DIM_DEFAULT, INFONCE_TEMPERATURE_DEFAULT), 'none')
+    elif dataset_name == 'mnist_svhn':
+        clf = MSClassifier(LATENT_DIM_DEFAULT, MSGMC('gmc', 'none', COMMON_DIM_DEFAULT, LATENT_DIM_DEFAULT, INFONCE_TEMPERATURE_DEFAULT), 'none')
+    else:
+        clf = MMClassifier(LATENT_DIM_DEFAULT, AffectGMC('gmc', 'none', LATENT_DIM_DEFAULT, LATENT_DIM_DEFAULT, INFONCE_TEMPERATURE_DEFAULT, scenario=dataset_name), 'none')
+    clf.eval()
+    for param in clf.parameters():
+        param.requires_grad = False
+    return clf.to(device)
+
+
+def get_synthetic_batch(dataset_name, batch_size, device):
+    x = {key: torch.rand((batch_size, *shape), device=device) for key, shape in BENCHMARK_DATASETS[dataset_name].items()}
+    if dataset_name == 'mosei':
+        return x, torch.rand((batch_size, 1), device=device)
+    return x, torch.randint(0, 10, (batch_size,), device=device)
+
+
+def get_attack_config(steps):
+    # Per-sample early stopping is disabled so that bim and pgd always run every step, cw can still stop the whole batch and counts its steps
+    return {
+        'noise_std': NOISE_STD_DEFAULT,
+        'adv_epsilon': ADV_EPSILON_DEFAULT,
+        'adv_alpha': ADV_ALPHA_DEFAULT,
+        'adv_steps': steps,
+        'adv_kappa': ADV_KAPPA_DEFAULT,
+        'adv_lr': ADV_LR_DEFAULT,
+        'adv_early_stop': False,
+        'adv_restarts': ADV_RESTARTS_DEFAULT,
+        'adv_max_batch': None,
+        'adv_search_steps': ADV_SEARCH_STEPS_DEFAULT
+    }
+
+
+def get_rss():
+    with open('/proc/self/statm', 'r') as statm_file:
+        return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def run_case(dataset_name, attack_name, target_modality, batch_size, steps, repeats, device):
+    clf = setup_benchmark_classifier(dataset_name, device)
+    attack = setup_attack(get_attack_config(steps), device, clf, attack_name, target_modality)
+    x, y = get_synthetic_batch(dataset_name, batch_size, device)
+    # ru_maxrss cannot be reset, so the CPU baseline is taken before the warm-up run reaches the peak of the case
+    if device.type != 'cuda':
+        base_memory = get_rss()
+
+    # Warm-up run, so that lazy initializations are not timed
+    attack(dict(x), y)
+    synchronize(device)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        base_memory = torch.cuda.memory_allocated(device)
+
+    attack_steps = steps if attack_name in ['bim', 'pgd', 'cw'] else 1
+    runs = []
+    for _ in range(repeats):
+        start = time.time()
+        attack(dict(x), y)
+        synchronize(device)
+        runs.append((time.time() - start, attack._executed_steps if attack_name == 'cw' else attack_steps))
+
+    if device.type == 'cuda':
+        peak_memory = torch.cuda.max_memory_allocated(device) - base_memory
+    else:
+        # ru_maxrss is reported in kilobytes and starts at the RSS the forked case inherits
+        peak_memory = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - base_memory, 0)
+
+    elapsed, attack_steps = min(runs)
+    return {
+        'dataset': dataset_name,
+        'attack': attack_name,
+        'target_modality': target_modality,
+        'batch_size': batch_size,
+        'steps': attack_steps,
+        'samples_per_sec': batch_size / max(elapsed, 1e-9),
+        'time_per_step': elapsed / attack_steps,
+        'peak_memory_mb': peak_memory / 1024 / 1024
+    }
+
+
+def _run_forked_case(connection, *args):
+    try:
+        connection.send(run_case(*args))
+    except Exception as exception:
+        connection.send(exception)
+    finally:
+        connection.close()
+
+
+def run_isolated_case(*args):
+    # CPU cases run in a forked process each, so the peak RSS of one case is not inherited by the next one
+    device = args[-1]
+    if device.type == 'cuda':
+        return run_case(*args)
+    context = multiprocessing.get_context('fork')
+    parent_connection, child_connection = context.Pipe(duplex=False)
+    process = context.Process(target=_run_forked_case, args=(child_connection, *args))
+    process.start()
+    result = parent_connection.recv()
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def run_benchmarks(dataset_names, attack_names, batch_sizes, steps, repeats, device):
+    results = []
+    for dataset_name in dataset_names:
+        for target_modality in BENCHMARK_DATASETS[dataset_name].keys():
+            for attack_name in attack_names:
+                for batch_size in batch_sizes:
+                    result = run_isolated_case(dataset_name, attack_name, target_modality, batch_size, steps, repeats, device)
+                    print(f"{dataset_name:<12}{target_modality:<12}{attack_name:<16}{batch_size:<8}{result['samples_per_sec']:>14.1f}{result['time_per_step'] * 1000:>14.2f}{result['peak_memory_mb']:>14.1f}")
+                    results.append(result)
+    return results
+
+
+def save_results(out_path, results, device, steps, repeats):
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    report = {
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'torch_version': torch.__version__,
+        'device': str(device),
+        'threads': torch.get_num_threads(),
+        'steps': steps,
+        'repeats': repeats,
+        'results': results
+    }
+    with open(out_path, 'w') as out_file:
+        json.dump(report, out_file, indent=4)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the throughput and memory of the adversarial attacks on synthetic data.')
+    parser.add_argument('--datasets', nargs='+', default=list(BENCHMARK_DATASETS.keys()), choices=list(BENCHMARK_DATASETS.keys()), help='Dataset shapes to benchmark.')
+    parser.add_argument('--attacks', nargs='+', default=BENCHMARK_ATTACKS, choices=BENCHMARK_ATTACKS, help='Attacks to benchmark.')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=BATCH_SIZES_DEFAULT, help='Batch sizes to benchmark.')
+    parser.add_argument('--steps', type=int, default=ADV_STEPS_DEFAULT, help='Number of steps of the iterative attacks (bim, pgd, cw).')
+    parser.add_argument('--repeats', type=int, default=REPEATS_DEFAULT, help='Timed runs per case, the fastest one is reported.')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='Device the attacks run on.')
+    parser.add_argument('--out', type=str, default=RESULTS_PATH_DEFAULT, help='Path of the JSON file the results are written to.')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    print(f"{'dataset':<12}{'target':<12}{'attack':<16}{'batch':<8}{'samples/s':>14}{'ms/step':>14}{'peak MB':>14}")
+    results = run_benchmarks(args.datasets, args.attacks, args.batch_sizes, args.steps, args.repeats, device)
+    save_results(args.out, results, device, args.steps, args.repeats)
+    print(f"Results written to {args.out}")
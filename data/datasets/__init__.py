@@ -1,5 +1,7 @@
-from mhd.mhd_dataset import MhdDataset
-from mnist_svhn.mnist_svhn_dataset import MnistSvhnDataset
-from mosei.mosei_dataset import MoseiDataset
-from mosi.mosi_dataset import MosiDataset
-from pendulum.pendulum_dataset import PendulumDataset
\ No newline at end of file
+from .mhd.mhd_dataset import MhdDataset
+from .mnist_svhn.mnist_svhn_dataset import MnistSvhnDataset
+from .mosei.mosei_dataset import MoseiDataset
+from .mosi.mosi_dataset import MosiDataset
+from .pendulum.pendulum_dataset import PendulumDataset
+from .multimodal_dataloader import MultimodalDataLoader
+from .length_bucket_sampler import LengthBucketBatchSampler
@@ -0,0 +1,100 @@
+import os
+import json
+import shutil
+import hashlib
+
+from .mmap_storage import MANIFEST_FILENAME, load_mmap_manifest, save_mmap_dataset
+
+
+FINGERPRINT_CHUNK_SIZE = 1 << 20
+FINGERPRINT_FILENAME = "fingerprints.json"
+ENTRIES_FILENAME = "entries.json"
+
+
+def get_cache_root(dataset_dir):
+    return os.path.join(dataset_dir, "cache")
+
+
+def fingerprint_file(path, cache_root=None):
+    # Hashing a multi-GB source on every start would defeat the cache, so digests are memoized per (size, mtime)
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    fingerprints = {}
+    fingerprints_path = None
+    if cache_root is not None:
+        fingerprints_path = os.path.join(cache_root, FINGERPRINT_FILENAME)
+        if os.path.isfile(fingerprints_path):
+            with open(fingerprints_path, 'r') as fingerprints_file:
+                fingerprints = json.load(fingerprints_file)
+        entry = fingerprints.get(os.path.abspath(path))
+        if entry is not None and entry['stamp'] == stamp:
+            return entry['sha256']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(FINGERPRINT_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    sha256 = digest.hexdigest()
+
+    if fingerprints_path is not None:
+        os.makedirs(cache_root, exist_ok=True)
+        fingerprints[os.path.abspath(path)] = {'stamp': stamp, 'sha256': sha256}
+        tmp_path = fingerprints_path + f".{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as fingerprints_file:
+            json.dump(fingerprints, fingerprints_file, indent=4)
+        os.replace(tmp_path, fingerprints_path)
+    return sha256
+
+
+def get_cache_key(source_path, recipe, cache_root=None):
+    digest = hashlib.sha256()
+    digest.update(fingerprint_file(source_path, cache_root).encode())
+    digest.update(json.dumps(recipe, sort_keys=True).encode())
+    return digest.hexdigest()[:32]
+
+
+def get_cache_dir(dataset_dir, source_path, recipe):
+    cache_root = get_cache_root(dataset_dir)
+    return os.path.join(cache_root, get_cache_key(source_path, recipe, cache_root))
+
+
+def register_cache_entry(dataset_dir, source_path, recipe, cache_dir):
+    # Drop the previous cache entry of the same source and recipe once its fingerprint no longer matches
+    cache_root = get_cache_root(dataset_dir)
+    entries_path = os.path.join(cache_root, ENTRIES_FILENAME)
+    entries = {}
+    if os.path.isfile(entries_path):
+        with open(entries_path, 'r') as entries_file:
+            entries = json.load(entries_file)
+
+    entry_key = os.path.abspath(source_path) + "|" + json.dumps(recipe, sort_keys=True)
+    stale_dir = entries.get(entry_key)
+    if stale_dir is not None and stale_dir != os.path.basename(cache_dir):
+        shutil.rmtree(os.path.join(cache_root, stale_dir), ignore_errors=True)
+
+    entries[entry_key] = os.path.basename(cache_dir)
+    os.makedirs(cache_root, exist_ok=True)
+    tmp_path = entries_path + f".{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as entries_file:
+        json.dump(entries, entries_file, indent=4)
+    os.replace(tmp_path, entries_path)
+
+
+def has_cached_modalities(cache_dir, modalities):
+    if not os.path.isfile(os.path.join(cache_dir, MANIFEST_FILENAME)):
+        return False
+    manifest = load_mmap_manifest(cache_dir)
+    return all(key in manifest['modalities'] for key in modalities)
+
+
+def save_cached_dataset(cache_dir, dataset, labels, normalization_stats, dequantization=None):
+    # Concurrent sweep processes may miss at the same time, so each one writes a private directory and renames it
+    tmp_dir = cache_dir + f".{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    manifest = save_mmap_dataset(tmp_dir, dataset, labels, normalization_stats, dequantization)
+    # An existing entry has the same key and is complete (it was renamed into place), so readers may keep using it
+    try:
+        os.replace(tmp_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return manifest
@@ -0,0 +1,54 @@
+import torch
+
+
+def get_sequence_lengths(sequences, chunk_size=4096):
+    # Sequences are front-padded, a timestep is padding when every feature of every modality holds the same value
+    n_samples, seq_len = sequences[0].size()[:2]
+    lengths = torch.empty(n_samples, dtype=torch.long)
+    for start in range(0, n_samples, chunk_size):
+        is_padding = torch.ones((min(chunk_size, n_samples - start), seq_len), dtype=torch.bool)
+        for sequence in sequences:
+            chunk = sequence[start:start + chunk_size].float()
+            is_padding &= (torch.amax(chunk, dim=-1) == torch.amin(chunk, dim=-1)).cpu()
+        lengths[start:start + chunk_size] = seq_len - torch.cumprod(is_padding.long(), dim=1).sum(dim=1)
+    return lengths
+
+
+class LengthBucketBatchSampler(object):
+    def __init__(self, lengths, seq_len, batch_size, shuffle=False, drop_last=False, bucket_batches=100):
+        self.lengths = lengths
+        self.seq_len = seq_len
+        self.batch_padding = None
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_size = batch_size * bucket_batches
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def get_padding(self, indices):
+        # Leading timesteps that are padding for every sample of the batch, from the lengths of the clean data
+        return min(self.seq_len - int(self.lengths[indices].max()), self.seq_len - 1)
+
+    def __iter__(self):
+        # Samples of similar length share a batch, so the per-batch padding that is trimmed away is as large as possible
+        if self.shuffle:
+            # Shuffled samples are only sorted within buckets of a few hundred batches, which keeps batches random across epochs
+            indices = torch.randperm(len(self.lengths))
+            buckets = [bucket[torch.argsort(self.lengths[bucket], stable=True)] for bucket in torch.split(indices, self.bucket_size)]
+            indices = torch.cat(buckets)
+        else:
+            indices = torch.argsort(self.lengths, stable=True)
+
+        batches = list(torch.split(indices, self.batch_size))
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            batches = [batches[batch_idx] for batch_idx in torch.randperm(len(batches)).tolist()]
+        for indices in batches:
+            # Batches are requested one at a time by the loaders, so this is the padding of the batch being loaded
+            self.batch_padding = self.get_padding(indices)
+            yield indices
@@ -0,0 +1,95 @@
+import os
+import json
+import torch
+import numpy as np
+
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+def get_mmap_dir(dataset_dir, train):
+    return os.path.join(dataset_dir, "mmap", "train" if train else "test")
+
+
+def _to_json(value):
+    if torch.is_tensor(value):
+        return value.tolist()
+    if isinstance(value, np.ndarray) or isinstance(value, np.generic):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [_to_json(val) for val in value]
+    if isinstance(value, dict):
+        return {key: _to_json(val) for key, val in value.items()}
+    return value
+
+
+def save_mmap_dataset(out_dir, dataset, labels, normalization_stats, dequantization=None):
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {'modalities': {}, 'missing': {}, 'labels': None, 'metadata': {}}
+    arrays = {}
+    for key, value in dataset.items():
+        if torch.is_tensor(value) and value.dim() > 0 and 0 in value.stride():
+            # Excluded modalities are stride-0 placeholders, only their shape is kept
+            manifest['missing'][key] = list(value.size())
+        elif torch.is_tensor(value):
+            arrays[key] = value
+    if labels is not None:
+        arrays['labels'] = labels
+
+    for key, tensor in arrays.items():
+        array = tensor.detach().cpu().numpy()
+        # Each modality is a plain .npy file so that it can be memory-mapped independently of the others
+        out_array = np.lib.format.open_memmap(os.path.join(out_dir, f"{key}.npy"), mode='w+', dtype=array.dtype, shape=array.shape)
+        out_array[...] = array
+        out_array.flush()
+        del out_array
+
+        entry = {'file': f"{key}.npy", 'shape': list(array.shape), 'dtype': str(array.dtype)}
+        if key == 'labels':
+            manifest['labels'] = entry
+        else:
+            entry['normalization'] = normalization_stats.get(key)
+            entry['dequantization'] = (dequantization or {}).get(key)
+            manifest['modalities'][key] = entry
+
+    for key, value in dataset.items():
+        if not torch.is_tensor(value):
+            manifest['metadata'][key] = _to_json(value)
+
+    # Manifest is written last so that an interrupted conversion is never picked up as a valid dataset
+    tmp_path = os.path.join(out_dir, MANIFEST_FILENAME + ".tmp")
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.replace(tmp_path, os.path.join(out_dir, MANIFEST_FILENAME))
+    return manifest
+
+
+def load_mmap_manifest(mmap_dir):
+    with open(os.path.join(mmap_dir, MANIFEST_FILENAME), 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def load_mmap_array(mmap_dir, entry):
+    # Copy-on-write mapping: pages are shared through the page cache and only read on first access
+    array = np.load(os.path.join(mmap_dir, entry['file']), mmap_mode='c')
+    if list(array.shape) != entry['shape'] or str(array.dtype) != entry['dtype']:
+        raise ValueError(f"Memory-mapped array {entry['file']} does not match its manifest entry.")
+    return torch.from_numpy(array)
+
+
+def load_mmap_dataset(mmap_dir, modalities, device):
+    manifest = load_mmap_manifest(mmap_dir)
+    dataset = {}
+    for key in modalities:
+        if key not in manifest['modalities']:
+            raise ValueError(f"Modality {key} not found in {os.path.join(mmap_dir, MANIFEST_FILENAME)}.")
+        dataset[key] = load_mmap_array(mmap_dir, manifest['modalities'][key])
+        if torch.device(device).type != 'cpu':
+            dataset[key] = dataset[key].to(device)
+
+    labels = None
+    if manifest['labels'] is not None:
+        labels = load_mmap_array(mmap_dir, manifest['labels']).to(device)
+
+    normalization_stats = {key: manifest['modalities'][key]['normalization'] for key in modalities}
+    return dataset, labels, manifest, normalization_stats
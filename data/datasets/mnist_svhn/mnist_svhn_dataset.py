@@ -4,16 +4,38 @@ import torchvision
 import numpy as np
 import matplotlib.pyplot as plt
 
-from tqdm import tqdm
 from ..multimodal_dataset import MultimodalDataset
 
 
+def label_rank(labels):
+    # Position of every sample among the samples of its digit, in dataset order
+    order = torch.argsort(labels, stable=True)
+    counts = torch.bincount(labels, minlength=10)
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(len(labels)) - torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+    return rank
+
+
+def pair_by_label(labels_a, labels_b):
+    # The i-th sample of each digit in one set is paired with the i-th of the same digit in the other, surplus samples are dropped
+    counts = torch.minimum(torch.bincount(labels_a, minlength=10), torch.bincount(labels_b, minlength=10))
+    order_a = torch.argsort(labels_a, stable=True)
+    order_b = torch.argsort(labels_b, stable=True)
+    idx_a = order_a[label_rank(labels_a)[order_a] < counts[labels_a[order_a]]]
+    idx_b = order_b[label_rank(labels_b)[order_b] < counts[labels_b[order_b]]]
+    return idx_a, idx_b
+
+
 # Adapted from https://github.com/iffsid/mmvae
 class MnistSvhnDataset(MultimodalDataset):
-    def __init__(self, name, dataset_dir, device, download=False, exclude_modality='none', target_modality='none', train=True, transform=None, adv_attack=None, max_d = 10000, dm=30):
-        super().__init__(name, dataset_dir, device, download, exclude_modality, target_modality, train, transform, adv_attack)
+    MODALITIES = ['mnist', 'svhn']
+    NORMALIZED_MODALITIES = ['mnist', 'svhn']
+    COMPACT_DTYPES = {'mnist': 'uint8', 'svhn': 'uint8'}
+
+    def __init__(self, name, dataset_dir, device, download=False, exclude_modality='none', target_modality='none', train=True, transform=None, adv_attack=None, max_d = 10000, dm=1, storage='pt', cache=False, modalities=None, storage_dtype='float32', pin_memory=False):
         self.max_d = max_d  # maximum number of datapoints per class
         self.dm = dm        # data multiplier: random permutations to match 
+        super().__init__(name, dataset_dir, device, download, exclude_modality, target_modality, train, transform, adv_attack, storage, cache, modalities, storage_dtype, pin_memory)
         
     @staticmethod
     def _download():
@@ -28,71 +50,53 @@ class MnistSvhnDataset(MultimodalDataset):
         train_svhn.labels = torch.LongTensor(train_svhn.labels.squeeze().astype(int)) % 10
         test_svhn.labels = torch.LongTensor(test_svhn.labels.squeeze().astype(int)) % 10
 
-        train_dict = {"mnist": [], "svhn": [], "labels": []}
-        svhn_dict = {"0": [], "1": [], "2": [], "3": [], "4": [], "5": [], "6": [], "7": [], "8": [], "9": []}
-        print("Exporting svhn train set...")
-        for feats, label in tqdm(zip(train_svhn.data, train_svhn.labels), total=len(train_svhn)):
-            svhn_dict[str(label.item())].append(feats)
-
-        mnist_dict = {"0": [], "1": [], "2": [], "3": [], "4": [], "5": [], "6": [], "7": [], "8": [], "9": []}
-        print("Exporting mnist train set...")
-        for feats, label in tqdm(zip(train_mnist.data, train_mnist.targets), total=len(train_mnist)):
-            mnist_dict[str(label.item())].append(feats)
-        
-        print("Combining training datasets...")
-        for dig in tqdm(svhn_dict.keys()):
-            for mnist_feats, svhn_feats in zip(mnist_dict[str(dig)], svhn_dict[str(dig)]):
-                train_dict["mnist"].append(mnist_feats[None, :])
-                train_dict["svhn"].append(torch.from_numpy(svhn_feats))
-                train_dict["labels"].append(torch.tensor(int(dig)))
-
-        train_dict["mnist"] = torch.stack(train_dict["mnist"])
-        train_dict["svhn"] = torch.stack(train_dict["svhn"])
-        train_dict["labels"] = torch.stack(train_dict["labels"])
-
-        test_dict = {"mnist": [], "svhn": [], "labels": []}
-        svhn_dict = {"0": [], "1": [], "2": [], "3": [], "4": [], "5": [], "6": [], "7": [], "8": [], "9": []}
-        print("Exporting svhn test set...")
-        for feats, label in tqdm(zip(test_svhn.data, test_svhn.labels), total=len(test_svhn)):
-            svhn_dict[str(label.item())].append(feats)
-
-        mnist_dict = {"0": [], "1": [], "2": [], "3": [], "4": [], "5": [], "6": [], "7": [], "8": [], "9": []}
-        print("Exporting mnist test set...")
-        for feats, label in tqdm(zip(test_mnist.data, test_mnist.targets), total=len(test_mnist)):
-            mnist_dict[str(label.item())].append(feats)
-        
-        print("Combining test datasets...")
-        for dig in tqdm(svhn_dict.keys()):
-            for mnist_feats, svhn_feats in zip(mnist_dict[str(dig)], svhn_dict[str(dig)]):
-                test_dict["mnist"].append(mnist_feats[None, :])
-                test_dict["svhn"].append(torch.from_numpy(svhn_feats))
-                test_dict["labels"].append(torch.tensor(int(dig)))
-
-        test_dict["mnist"] = torch.stack(test_dict["mnist"])
-        test_dict["svhn"] = torch.stack(test_dict["svhn"])
-        test_dict["labels"] = torch.stack(test_dict["labels"])
-
-        torch.save(train_dict, os.path.join("datasets", "mnist_svhn", 'mnist_svhn_train.pt'))
-        torch.save(test_dict, os.path.join("datasets", "mnist_svhn", 'mnist_svhn_test.pt'))
+        for data_set, mnist, svhn in [('train', train_mnist, train_svhn), ('test', test_mnist, test_svhn)]:
+            print(f"Combining {data_set} datasets...")
+            mnist_idx, svhn_idx = pair_by_label(mnist.targets, svhn.labels)
+            data_dict = {
+                "mnist": mnist.data[mnist_idx][:, None],
+                "svhn": torch.from_numpy(svhn.data)[svhn_idx],
+                "labels": mnist.targets[mnist_idx]
+            }
+            torch.save(data_dict, os.path.join("datasets", "mnist_svhn", f'mnist_svhn_{data_set}.pt'))
     
-    def _load_data(self, train):
+    def _get_data_path(self, train):
         if train:
-            data_path = os.path.join(self.dataset_dir, "mnist_svhn_train.pt")
+            return os.path.join(self.dataset_dir, "mnist_svhn_train.pt")
         else:
-            data_path = os.path.join(self.dataset_dir, "mnist_svhn_test.pt")
+            return os.path.join(self.dataset_dir, "mnist_svhn_test.pt")
+
+    def _load_data(self, train):
+        data_path = self._get_data_path(train)
 
         data = torch.load(data_path)
         self.dataset_len = len(data["labels"])
 
-        # Normalize datasets
+        # Normalization and device transfer are applied by the base class to the consumed modalities only
         self.dataset = {
-            'mnist': (data['mnist'] - torch.min(data['mnist'])) / (torch.max(data['mnist']) - torch.min(data['mnist'])),    # size (n_samples x n_channels x npixels_width x npixels_height) = 56068||10000 x 1 x 28 x 28
-            'svhn': (data['svhn'] - torch.min(data['svhn'])) / (torch.max(data['svhn']) - torch.min(data['svhn']))          # size (n_samples x n_channels x npixels_width x npixels_height) = 56068||10000 x 3 x 32 x 32
+            'mnist': data['mnist'],     # size (n_samples x n_channels x npixels_width x npixels_height) = 56068||10000 x 1 x 28 x 28
+            'svhn': data['svhn']        # size (n_samples x n_channels x npixels_width x npixels_height) = 56068||10000 x 3 x 32 x 32
         }
-        self.labels = data["labels"].to(self.device)                                                                        # size (n_samples) = 56068||10000 (int value)
-        if self.exclude_modality != 'none' and self.exclude_modality is not None:
-            self.dataset[self.exclude_modality] = torch.full(self.dataset[self.exclude_modality], -1).to(self.device)
+        self.labels = data["labels"]    # size (n_samples) = 56068||10000 (int value)
     
+    def _build_index_maps(self):
+        # Virtual pairs: dm rounds of digit-preserving permutations of the stored pairs, kept as index maps instead of copied pixels
+        labels = self.labels.cpu()
+        pool = torch.nonzero(label_rank(labels) < self.max_d).squeeze(1)
+        if self.dm <= 1 and len(pool) == len(labels):
+            return
+
+        pool_labels = labels[pool].double()
+        mnist_idx, svhn_idx = [pool], [pool]
+        for _ in range(self.dm - 1):
+            # Sorting by label plus a uniform offset in [0, 1) shuffles within each digit and keeps both sides label-aligned
+            mnist_idx.append(pool[torch.argsort(pool_labels + torch.rand(len(pool), dtype=torch.float64))])
+            svhn_idx.append(pool[torch.argsort(pool_labels + torch.rand(len(pool), dtype=torch.float64))])
+
+        mnist_idx = torch.cat(mnist_idx).to(self.labels.device)
+        self.index_maps = {'mnist': mnist_idx, 'svhn': torch.cat(svhn_idx).to(self.labels.device), 'labels': mnist_idx}
+        self.dataset_len = len(mnist_idx)
+
     def _show_dataset_label_distribution(self):
         label_dict = {"0": 0, "1": 0, "2": 0, "3": 0, "4": 0, "5": 0, "6": 0, "7": 0, "8": 0, "9": 0}
         for data_set in ['train', 'test']:
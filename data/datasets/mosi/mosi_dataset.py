@@ -3,11 +3,17 @@ import torch
 import subprocess
 
 from ..multimodal_dataset import MultimodalDataset
+from ..length_bucket_sampler import get_sequence_lengths
 
 
 class MosiDataset(MultimodalDataset):
-    def __init__(self, dataset_dir, device, download=False, exclude_modality='none', target_modality='none', train=True, transform=None, adv_attack=None):
-        super().__init__(dataset_dir, device, download, exclude_modality, target_modality, train, transform, adv_attack)
+    MODALITIES = ['text', 'audio', 'vision']
+    NORMALIZED_MODALITIES = ['text', 'audio', 'vision']
+    COMPACT_DTYPES = {'text': 'float16', 'audio': 'float16', 'vision': 'float16'}
+
+    def __init__(self, name, dataset_dir, device, download=False, exclude_modality='none', target_modality='none', train=True, transform=None, adv_attack=None, storage='pt', cache=False, modalities=None, storage_dtype='float32', pin_memory=False):
+        self.sequence_lengths = None
+        super().__init__(name, dataset_dir, device, download, exclude_modality, target_modality, train, transform, adv_attack, storage, cache, modalities, storage_dtype, pin_memory)
 
     @staticmethod
     def _download():
@@ -21,24 +27,25 @@ class MosiDataset(MultimodalDataset):
         dataset = {'text': data.text, 'audio': data.audio, 'vision': data.vision, 'labels': data.labels}
         torch.save(dataset, os.path.join(dataset_dir, "mosi_test.pt"))
     
-    def _load_data(self, train):     
+    def _get_data_path(self, train):
         if train:
-            data_path = os.path.join(self.dataset_dir, "mosi_train.pt")
-            
+            return os.path.join(self.dataset_dir, "mosi_train.pt")
         else:
-            data_path = os.path.join(self.dataset_dir, "mosi_test.pt")
+            return os.path.join(self.dataset_dir, "mosi_test.pt")
+
+    def _load_data(self, train):
+        data_path = self._get_data_path(train)
 
         data = torch.load(data_path)
         self.dataset = {
-            'text': data['text'].to(self.device), 
-            'audio': data['audio'].to(self.device), 
-            'vision': data['vision'].to(self.device)
+            'text': data['text'], 
+            'audio': data['audio'], 
+            'vision': data['vision']
         }
-        self.labels = data['labels'].to(self.device)
+        self.labels = data['labels']
         self.dataset_len = len(self.labels)
-        for mod in ['text', 'audio', 'vision']:
-            if mod != self.exclude_modality:
-                self.dataset[mod] = (self.dataset[mod] - torch.min(self.dataset[mod])) / (torch.max(self.dataset[mod]) - torch.min(self.dataset[mod]))
 
-        if self.exclude_modality != 'none' and self.exclude_modality is not None:
-            self.dataset[self.exclude_modality] = torch.full(self.dataset[self.exclude_modality], -1).to(self.device)
\ No newline at end of file
+    def _get_sequence_lengths(self):
+        if self.sequence_lengths is None:
+            self.sequence_lengths = get_sequence_lengths([self.dataset[key] for key in self._get_loaded_modalities()])
+        return self.sequence_lengths
\ No newline at end of file
@@ -0,0 +1,78 @@
+import torch
+
+
+class MultimodalDataLoader(object):
+    def __init__(self, dataset, batch_size=1, shuffle=False, drop_last=False, batch_sampler=None):
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def _get_device(self):
+        if self.dataset.labels is not None:
+            return self.dataset.labels.device
+        return self.dataset.dataset[self.dataset._get_loaded_modalities()[0]].device
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def _get_indices(self):
+        # Indices live on the same device as the dataset tensors, so batches are gathered without host round-trips
+        device = self._get_device()
+        if self.batch_sampler is not None:
+            batches = list(self.batch_sampler)
+            self.batch_paddings = [self.batch_sampler.get_padding(indices) for indices in batches]
+            return [indices.to(device) for indices in batches]
+        if self.shuffle:
+            indices = torch.randperm(len(self.dataset), device=device)
+        else:
+            indices = torch.arange(len(self.dataset), device=device)
+        return [indices[batch_idx * self.batch_size:(batch_idx + 1) * self.batch_size] for batch_idx in range(len(self))]
+
+    def _iter_prefetched(self, batch_indices):
+        # Double buffering: the next batch is gathered into a pinned slot and copied on a side stream while the current step runs
+        device = torch.device(self.dataset.device)
+        copy_stream = torch.cuda.Stream(device=device)
+        buffers = [self.dataset._allocate_batch_buffers(self.batch_size) for _ in range(2)]
+        copy_events = [None, None]
+
+        def prefetch(batch_idx):
+            slot = batch_idx % 2
+            if copy_events[slot] is not None:
+                # The slot is only overwritten once its previous copy to the device has completed
+                copy_events[slot].synchronize()
+            data, labels = self.dataset._gather_batch(batch_indices[batch_idx], buffers[slot])
+            with torch.cuda.stream(copy_stream):
+                data, labels = self.dataset._transfer_batch(data, labels)
+                copy_events[slot] = torch.cuda.Event()
+                copy_events[slot].record(copy_stream)
+            return data, labels, copy_events[slot]
+
+        next_batch = prefetch(0) if len(batch_indices) > 0 else None
+        for batch_idx in range(len(batch_indices)):
+            data, labels, copy_event = next_batch
+            if batch_idx + 1 < len(batch_indices):
+                next_batch = prefetch(batch_idx + 1)
+
+            compute_stream = torch.cuda.current_stream(device)
+            compute_stream.wait_event(copy_event)
+            for tensor in list(data.values()) + ([labels] if labels is not None else []):
+                tensor.record_stream(compute_stream)
+            yield self.dataset._process_batch(data, labels)
+
+    def __iter__(self):
+        batch_indices = self._get_indices()
+        if self.dataset.pin_memory:
+            batches = self._iter_prefetched(batch_indices)
+        else:
+            batches = (self.dataset._get_batch(indices) for indices in batch_indices)
+        for batch_idx, batch in enumerate(batches):
+            if self.batch_sampler is not None:
+                # All the indices are drawn up front (and the next batch is prefetched), so the sampler is pointed at the yielded one
+                self.batch_sampler.batch_padding = self.batch_paddings[batch_idx]
+            yield batch
@@ -1,8 +1,17 @@
 import torch
 
+from .mmap_storage import get_mmap_dir, load_mmap_dataset, save_mmap_dataset
+from .dataset_cache import get_cache_dir, has_cached_modalities, register_cache_entry, save_cached_dataset
+
 
 class MultimodalDataset(torch.utils.data.Dataset):
-    def __init__(self, name, dataset_dir, device, download=False, exclude_modality='none', target_modality='none', train=True, transform=None, adv_attack=None):
+    MODALITIES = []
+    NORMALIZED_MODALITIES = []
+    NORMALIZATION_RECIPE = {'normalization': 'global_minmax', 'version': 1}
+    COMPACT_DTYPES = {}
+    FLOAT16_TOLERANCE = 1e-3
+
+    def __init__(self, name, dataset_dir, device, download=False, exclude_modality='none', target_modality='none', train=True, transform=None, adv_attack=None, storage='pt', cache=False, modalities=None, storage_dtype='float32', pin_memory=False):
         super().__init__()
         if download:
             self._download()
@@ -14,20 +23,159 @@ class MultimodalDataset(torch.utils.data.Dataset):
         self.transform = transform
         self.adv_attack = adv_attack
         self.target_modality = target_modality
+        self.storage = storage
+        self.cache = cache
+        self.storage_dtype = storage_dtype
+        self.pin_memory = pin_memory and torch.device(device).type == 'cuda'
         self.dataset = {}
         self.dataset_len = 0
         self.labels = None
-        self.modalities = None
-        self._load_data(train)
+        self.modalities = list(self.MODALITIES) if modalities is None else [key for key in self.MODALITIES if key in modalities]
+        self.missing_modalities = []
+        self.normalization_stats = {}
+        self.dequantization = {}
+        self.index_maps = {}
+        if self.storage == 'mmap':
+            self._load_mmap_dir(get_mmap_dir(self.dataset_dir, train))
+        elif self.cache:
+            self._load_cached_data(train)
+        else:
+            self._load_data(train)
+            self._prepare_modalities()
+        self._build_index_maps()
 
     def _download(self):
         raise NotImplementedError
-    
+
+    def _get_data_path(self, train):
+        raise NotImplementedError
+
     def _load_data(self, train):
         raise NotImplementedError
     
     def _show_dataset_label_distribution(self):
         raise NotImplementedError
+
+    def _get_excluded_modalities(self):
+        if self.exclude_modality != 'none' and self.exclude_modality is not None:
+            return [self.exclude_modality]
+        return []
+
+    def _get_loaded_modalities(self):
+        excluded = self._get_excluded_modalities()
+        return [key for key in self.modalities if key not in excluded]
+
+    def _normalize(self, key, tensor):
+        t_min, t_max = torch.min(tensor), torch.max(tensor)
+        self.normalization_stats[key] = {'min': float(t_min), 'max': float(t_max)}
+        return (tensor - t_min) / (t_max - t_min)
+
+    def _prepare_modalities(self):
+        # Modalities that are not consumed are dropped before normalization and device transfer
+        shapes = {key: self.dataset[key].size() for key in self.modalities if key in self.dataset}
+        loaded = self._get_loaded_modalities()
+        for key in [key for key, value in self.dataset.items() if torch.is_tensor(value) and key not in loaded]:
+            del self.dataset[key]
+
+        for key in loaded:
+            if key in self.NORMALIZED_MODALITIES:
+                self.dataset[key] = self._normalize(key, self.dataset[key])
+            if self.storage_dtype == 'compact':
+                self.dataset[key] = self._compact(key, self.dataset[key])
+            self.dataset[key] = self._to_storage(self.dataset[key])
+
+        if self.labels is not None:
+            self.labels = self._to_storage(self.labels)
+        self._exclude_modalities(shapes)
+
+    def _build_index_maps(self):
+        pass
+
+    def _get_rows(self, key, indices):
+        # Virtual samples are mapped to the stored rows of each modality, which lets several samples share the same data
+        if key in self.index_maps:
+            return self.index_maps[key][indices]
+        return indices
+
+    def _to_storage(self, tensor):
+        # Pinned datasets stay on the host so that only the batches are copied to the device, asynchronously
+        if self.pin_memory:
+            return tensor.cpu().pin_memory()
+        return tensor.to(self.device)
+
+    def _compact(self, key, tensor):
+        # Modalities stay resident in their compact dtype and are converted back to float32 one batch at a time
+        compact_dtype = self.COMPACT_DTYPES.get(key)
+        stats = self.normalization_stats.get(key)
+        if compact_dtype == 'uint8' and stats is not None:
+            t_min, t_max = stats['min'], stats['max']
+            raw = tensor * (t_max - t_min) + t_min
+            if t_min >= 0 and t_max <= 255 and torch.max(torch.abs(raw - torch.round(raw))) < 1e-3:
+                # 8-bit sources are kept as their raw pixel values, which makes the round trip exact
+                self.dequantization[key] = {'scale': 1. / (t_max - t_min), 'offset': -t_min / (t_max - t_min)}
+                return torch.round(raw).to(torch.uint8)
+            self.dequantization[key] = {'scale': 1. / 255, 'offset': 0.}
+            return torch.round(tensor * 255).to(torch.uint8)
+        if compact_dtype == 'float16':
+            half = tensor.half()
+            if torch.max(torch.abs(half.float() - tensor)) <= self.FLOAT16_TOLERANCE:
+                return half
+        return tensor
+
+    def _dequantize(self, key, tensor):
+        if key in self.dequantization:
+            return tensor.float().mul_(self.dequantization[key]['scale']).add_(self.dequantization[key]['offset'])
+        return tensor.float()
+
+    def _exclude_modalities(self, shapes):
+        # Excluded modalities are a stride-0 view of a single -1 value, so they cost no memory per sample
+        loaded = self._get_loaded_modalities()
+        self.missing_modalities = [key for key in self.modalities if key not in loaded]
+        for key in self.missing_modalities:
+            self.dataset[key] = torch.full((), -1., device=self.device).expand(tuple(shapes[key]))
+
+    def _load_mmap_dir(self, mmap_dir):
+        loaded = self._get_loaded_modalities()
+        self.dataset, self.labels, manifest, self.normalization_stats = load_mmap_dataset(mmap_dir, loaded, 'cpu')
+        for key in loaded:
+            dequantization = manifest['modalities'][key].get('dequantization')
+            if dequantization is not None:
+                self.dequantization[key] = dequantization
+                if self.storage_dtype != 'compact':
+                    self.dataset[key] = self._dequantize(key, self.dataset[key])
+                    del self.dequantization[key]
+            elif self.storage_dtype == 'compact':
+                self.dataset[key] = self._compact(key, self.dataset[key])
+            if torch.device(self.device).type != 'cpu':
+                self.dataset[key] = self._to_storage(self.dataset[key])
+        if self.labels is not None:
+            self.labels = self._to_storage(self.labels)
+        self.dataset.update(manifest['metadata'])
+        self._exclude_modalities({**manifest.get('missing', {}), **{key: entry['shape'] for key, entry in manifest['modalities'].items()}})
+
+        if self.labels is not None:
+            self.dataset_len = len(self.labels)
+        else:
+            self.dataset_len = manifest['modalities'][self._get_loaded_modalities()[0]]['shape'][0]
+
+    def _get_normalization_recipe(self):
+        # The cache only holds the loaded modalities, so runs excluding different modalities get their own entries
+        return {'dataset': self.__class__.__name__, 'storage_dtype': self.storage_dtype, 'modalities': sorted(self._get_loaded_modalities()), **self.NORMALIZATION_RECIPE}
+
+    def _load_cached_data(self, train):
+        source_path = self._get_data_path(train)
+        recipe = self._get_normalization_recipe()
+        cache_dir = get_cache_dir(self.dataset_dir, source_path, recipe)
+        if has_cached_modalities(cache_dir, self._get_loaded_modalities()):
+            self._load_mmap_dir(cache_dir)
+        else:
+            self._load_data(train)
+            self._prepare_modalities()
+            save_cached_dataset(cache_dir, self.dataset, self.labels, self.normalization_stats, self.dequantization)
+            register_cache_entry(self.dataset_dir, source_path, recipe, cache_dir)
+
+    def _export_mmap(self, train):
+        return save_mmap_dataset(get_mmap_dir(self.dataset_dir, train), self.dataset, self.labels, self.normalization_stats, self.dequantization)
     
     def _get_name(self):
         return self.name
@@ -41,24 +189,94 @@ class MultimodalDataset(torch.utils.data.Dataset):
     def _set_adv_attack(self, adv_attack):
         self.adv_attack = adv_attack
 
+    def _get_batch_modalities(self):
+        return [key for key in self.modalities if key in self.dataset]
+
     def __len__(self):
         return self.dataset_len
     
     def __getitem__(self, index):
-        data = dict.fromkeys(self.dataset.keys())
-        for key in data.keys():
-            data[key] = self.dataset[key][index].type(torch.cuda.FloatTensor)
+        data = {key: self.dataset[key][self._get_rows(key, index)] for key in self._get_batch_modalities()}
+        labels = self.labels[self._get_rows('labels', index)] if self.labels is not None else None
+        data, labels = self._transfer_batch(data, labels)
+        data = {key: self._dequantize(key, value) for key, value in data.items()}
+        return self._apply_transforms(data, labels)
+
+    def _allocate_batch_buffers(self, batch_size):
+        buffers = {key: torch.empty((batch_size,) + tuple(self.dataset[key].size()[1:]), dtype=self.dataset[key].dtype).pin_memory() for key in self._get_loaded_modalities()}
+        if self.labels is not None:
+            buffers['labels'] = torch.empty((batch_size,) + tuple(self.labels.size()[1:]), dtype=self.labels.dtype).pin_memory()
+        return buffers
 
+    def _gather_batch(self, indices, buffers=None):
+        # With pinned buffers the gather writes straight into page-locked memory, which keeps the copy to the device asynchronous
+        data = {}
+        for key in self._get_loaded_modalities():
+            out = buffers[key][:len(indices)] if buffers is not None else None
+            data[key] = torch.index_select(self.dataset[key], 0, self._get_rows(key, indices), out=out)
+        labels = None
         if self.labels is not None:
-            labels = self.labels[index]
+            out = buffers['labels'][:len(indices)] if buffers is not None else None
+            labels = torch.index_select(self.labels, 0, self._get_rows('labels', indices), out=out)
+        return data, labels
 
+    def _transfer_batch(self, data, labels):
+        data = {key: value.to(self.device, non_blocking=True) for key, value in data.items()}
+        if labels is not None:
+            labels = labels.to(self.device, non_blocking=True)
+        return data, labels
+
+    def _process_batch(self, data, labels):
+        data = {key: self._dequantize(key, value) for key, value in data.items()}
+        batch_size = len(labels) if labels is not None else len(next(iter(data.values())))
+        for key in self.missing_modalities:
+            data[key] = self.dataset[key][:batch_size]
+        return self._apply_transforms(data, labels)
+
+    def _apply_transforms(self, data, labels):
         if self.transform is not None:
             data = self.transform(data)
 
         if self.adv_attack is not None:
-            if self.labels is not None:
+            if labels is not None:
                 data = self.adv_attack(data, labels)
             else:
                 data = self.adv_attack(data, data)
 
-        return data, labels
\ No newline at end of file
+        return data, labels
+
+    def _get_stored_len(self):
+        if self.labels is not None:
+            return len(self.labels)
+        return self.dataset[self._get_loaded_modalities()[0]].size(0)
+
+    def _get_chunk(self, start, end):
+        # Stored samples [start, end) as float32 on the device, without index maps, transforms or attacks
+        data = {key: self._dequantize(key, self.dataset[key][start:end].to(self.device, non_blocking=True)) for key in self._get_loaded_modalities()}
+        for key in self.missing_modalities:
+            data[key] = self.dataset[key][:end - start]
+        labels = self.labels[start:end].to(self.device, non_blocking=True) if self.labels is not None else None
+        return data, labels
+
+    def _get_bounds(self, key, chunk_size=1024):
+        # Min and max over all stored samples, so chunked attacks clamp to the same range as an attack on the whole modality
+        lower, upper = float('inf'), float('-inf')
+        for start in range(0, self._get_stored_len(), chunk_size):
+            chunk = self._dequantize(key, self.dataset[key][start:start + chunk_size].to(self.device, non_blocking=True))
+            lower, upper = min(lower, chunk.min().item()), max(upper, chunk.max().item())
+        return lower, upper
+
+    def _allocate_modality(self, key):
+        device = self.dataset[key].device
+        return torch.empty(self.dataset[key].size(), dtype=torch.float32, device=device, pin_memory=self.pin_memory and device.type == 'cpu')
+
+    def _set_modality(self, key, tensor):
+        # Replaces a modality with normalized float32 values, such as the output of an offline attack
+        if tensor.device != self.dataset[key].device:
+            tensor = self._to_storage(tensor)
+        self.dataset[key] = tensor
+        self.dequantization.pop(key, None)
+
+    def _get_batch(self, indices):
+        # Slice every modality with a single index tensor instead of collating per-sample dicts
+        return self._process_batch(*self._transfer_batch(*self._gather_batch(indices)))
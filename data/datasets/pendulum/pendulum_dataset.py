@@ -6,8 +6,12 @@ from ..multimodal_dataset import MultimodalDataset
 
 
 class PendulumDataset(MultimodalDataset):
-    def __init__(self, dataset_dir, device, download=False, exclude_modality='none', target_modality='none', train=True, transform=None, adv_attack=None):
-        super().__init__(dataset_dir, device, download, exclude_modality, target_modality, train, transform, adv_attack)
+    MODALITIES = ['image_t', 'audio_t', 'reward_t', 'done_t', 'image_t++', 'audio_t++']
+    NORMALIZED_MODALITIES = ['audio_t', 'audio_t++']
+    COMPACT_DTYPES = {'image_t': 'uint8', 'image_t++': 'uint8', 'audio_t': 'float16', 'audio_t++': 'float16'}
+
+    def __init__(self, name, dataset_dir, device, download=False, exclude_modality='none', target_modality='none', train=True, transform=None, adv_attack=None, storage='pt', cache=False, modalities=None, storage_dtype='float32', pin_memory=False):
+        super().__init__(name, dataset_dir, device, download, exclude_modality, target_modality, train, transform, adv_attack, storage, cache, modalities, storage_dtype, pin_memory)
 
     @staticmethod
     def _download():
@@ -18,30 +22,32 @@ class PendulumDataset(MultimodalDataset):
         for name_before, name_after in zip(before_filenames, after_filenames):
             os.rename(name_before, name_after)
     
-    def _load_data(self, train):
+    def _get_excluded_modalities(self):
+        excluded = ['image_t', 'image_t++']
+        if self.exclude_modality != 'none' and self.exclude_modality is not None:
+            excluded.extend([f'{self.exclude_modality}', f'{self.exclude_modality}++'])
+        return excluded
+
+    def _get_data_path(self, train):
         if train:
-            data_path = os.path.join(self.dataset_dir, "train_dataset_samples20000_stack2_freq440.0_vel20.0_rec.pt")
+            return os.path.join(self.dataset_dir, "train_dataset_samples20000_stack2_freq440.0_vel20.0_rec.pt")
         else:
-            data_path = os.path.join(self.dataset_dir, "test_dataset_samples2000_stack2_freq440.0_vel20.0_rec.pt")
+            return os.path.join(self.dataset_dir, "test_dataset_samples2000_stack2_freq440.0_vel20.0_rec.pt")
+
+    def _load_data(self, train):
+        data_path = self._get_data_path(train)
         
         data = torch.load(data_path)
         self.dataset_len = len(data[0])
 
-        # Normalize datasets
-        data[0] = (data[0] - torch.min(data[0])) / (torch.max(data[0]) - torch.min(data[0]))
-        data[1] = (data[1] - torch.min(data[1])) / (torch.max(data[1]) - torch.min(data[1]))
-        data[4] = (data[4] - torch.min(data[4])) / (torch.max(data[4]) - torch.min(data[4]))
-        data[5] = (data[5] - torch.min(data[5])) / (torch.max(data[5]) - torch.min(data[5]))
+        # Image frames are always replaced by the -1 placeholder (see _get_excluded_modalities)
         self.dataset = {
-            'image_t': torch.full(data[0].size(), -1).to(self.device),      # size (n_samples x n_channels x npixels_width x npixels_height) = 20000||2000 x 2 x 60 x 60
-            'audio_t': data[1].to(self.device),                             # size (n_samples x n_channels x n_microphones x sound_features[amplitude, frequency]) = 20000||2000 x 2 x 3 x 2
-            'reward_t': data[2].to(self.device),                            # size (n_samples x 1) = 20000||2000 x 1 (float value)
-            'done_t': data[3].to(self.device),                              # size (n_samples) = 20000||2000 (boolean value)
-            'image_t++': torch.full(data[4].size(), -1).to(self.device),    # size (n_samples x n_channels x npixels_width x npixels_height) = 20000||2000 x 2 x 60 x 60
-            'audio_t++': data[5].to(self.device),                           # size (n_samples x n_channels x n_microphones x sound_features[amplitude, frequency]) = 20000||2000 x 2 x 3 x 2
-            'amplitude': data[7]['amplitude'],                              # [np.float64, np.float64]
-            'frequency': data[7]['frequency']                               # [np.float64, np.float64]
+            'image_t': data[0],             # size (n_samples x n_channels x npixels_width x npixels_height) = 20000||2000 x 2 x 60 x 60
+            'audio_t': data[1],             # size (n_samples x n_channels x n_microphones x sound_features[amplitude, frequency]) = 20000||2000 x 2 x 3 x 2
+            'reward_t': data[2],            # size (n_samples x 1) = 20000||2000 x 1 (float value)
+            'done_t': data[3],              # size (n_samples) = 20000||2000 (boolean value)
+            'image_t++': data[4],           # size (n_samples x n_channels x npixels_width x npixels_height) = 20000||2000 x 2 x 60 x 60
+            'audio_t++': data[5],           # size (n_samples x n_channels x n_microphones x sound_features[amplitude, frequency]) = 20000||2000 x 2 x 3 x 2
+            'amplitude': data[7]['amplitude'],  # [np.float64, np.float64]
+            'frequency': data[7]['frequency']   # [np.float64, np.float64]
         }
-        if self.exclude_modality != 'none' and self.exclude_modality is not None:
-            self.dataset[f'{self.exclude_modality}'] = torch.full(self.dataset[f'{self.exclude_modality}'].size(), -1).to(self.device)
-            self.dataset[f'{self.exclude_modality}++'] = torch.full(self.dataset[f'{self.exclude_modality}++'].size(), -1).to(self.device)
\ No newline at end of file
@@ -7,7 +7,7 @@ from torch.utils.data.dataset import Dataset
 
 # Code adapted from https://github.com/miguelsvasco/gmc
 class AffectDataset(Dataset):
-    def __init__(self, dataset_path, split_type='train', if_align=True):
+    def __init__(self, dataset_path, split_type='train', if_align=True, device='cpu'):
         super(AffectDataset, self).__init__()
         dataset_path = os.path.join(dataset_path, 'mosei_data.pkl' if if_align else 'mosei_data_noalign.pkl')
         dataset = pickle.load(open(dataset_path, 'rb'))
@@ -25,6 +25,11 @@ class AffectDataset(Dataset):
 
         self.n_modalities = 3  # vision/ text/ audio
 
+        # Tensors stay on the host (pinned when targeting a GPU) and items are copied asynchronously to the device
+        self.device = torch.device(device)
+        if self.device.type == 'cuda':
+            self.vision, self.text, self.audio, self.labels = [tensor.pin_memory() for tensor in [self.vision, self.text, self.audio, self.labels]]
+
     def get_n_modalities(self):
         return self.n_modalities
 
@@ -42,7 +47,7 @@ class AffectDataset(Dataset):
         return len(self.labels)
 
     def __getitem__(self, index):
-        X = (index, self.text[index].cuda(), self.audio[index].cuda(), self.vision[index].cuda())
-        Y = self.labels[index].cuda()
+        X = (index, self.text[index].to(self.device, non_blocking=True), self.audio[index].to(self.device, non_blocking=True), self.vision[index].to(self.device, non_blocking=True))
+        Y = self.labels[index].to(self.device, non_blocking=True)
         META = (0, 0, 0) if self.meta is None else (self.meta[index][0], self.meta[index][1], self.meta[index][2])
         return X, Y, META        
@@ -2,4 +2,8 @@ from cw import CW
 from pgd import PGD
 from bim import BIM
 from fgsm import FGSM
-from gaussian_noise import GaussianNoise
\ No newline at end of file
+from gaussian_noise import GaussianNoise
+from attack_runner import run_attack
+from attack_farm import run_attack_farm
+from attack_cache import run_cached_attack, get_attack_cache_key
+from attack_ensemble import run_attack_ensemble
@@ -1,3 +1,8 @@
+import torch
+
+from contextlib import contextmanager
+
+
 # Code adapted from https://github.com/Harry24k/adversarial-attacks-pytorch/blob/master/torchattacks/attack.py#L419
 class AdversarialAttack(object):
     def __init__(self, name, model, device, target_modality, targeted=False, attack_mode="default"):
@@ -8,6 +13,7 @@ class AdversarialAttack(object):
         self.attack_mode = attack_mode
         self.supported_modes = ['default']
         self.target_modality = target_modality
+        self.bounds = None
 
     def __call__(self, x, y):
         raise NotImplementedError
@@ -24,6 +30,18 @@ class AdversarialAttack(object):
             if not quiet:
                 print("Attack mode is changed to '%s'." % mode)
 
+    @contextmanager
+    def _frozen_model(self):
+        # Only the target modality requires grad, so with frozen weights autograd records nothing for the other modality branches
+        params = [param for param in self.model.parameters() if param.requires_grad]
+        for param in params:
+            param.requires_grad = False
+        try:
+            yield
+        finally:
+            for param in params:
+                param.requires_grad = True
+
     def _get_target_label(self, inputs, labels=None):
         if self.attack_mode == 'targeted(label)':
             target_labels = labels
@@ -36,4 +54,24 @@ class AdversarialAttack(object):
         return target_labels
     
     def _set_target_modality(self, target_modality):
-        self.target_modality = target_modality
\ No newline at end of file
+        self.target_modality = target_modality
+
+    def _set_bounds(self, bounds):
+        self.bounds = bounds
+
+    def _get_class_labels(self, y, result):
+        # Per-sample success can only be judged for classifiers trained on class indices
+        if y is None or result.dim() != 2 or result.size(-1) < 2:
+            return None
+        if y.dim() == 1 and not torch.is_floating_point(y):
+            return y
+        if y.dim() == 2 and y.size(-1) == result.size(-1):
+            return torch.argmax(y, dim=-1)
+        return None
+
+    def _is_successful(self, result, labels):
+        preds = torch.argmax(result, dim=-1)
+        if self.targeted:
+            return preds == labels
+        return preds != labels
+
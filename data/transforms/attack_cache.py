@@ -0,0 +1,80 @@
+import os
+import json
+import shutil
+import inspect
+import hashlib
+
+from .attack_farm import run_attack_farm
+from ..datasets.mmap_storage import MANIFEST_FILENAME, load_mmap_array
+from ..datasets.dataset_cache import fingerprint_file, get_cache_root
+
+
+ATTACK_CACHE_DIRNAME = "adversarial_cache"
+
+
+def get_model_fingerprint(model):
+    digest = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def get_attack_code_fingerprint(attack):
+    # Source of the attack class and its bases, so a change in how an attack perturbs invalidates the entries written before it
+    digest = hashlib.sha256()
+    for cls in type(attack).__mro__[:-1]:
+        digest.update(inspect.getsource(cls).encode())
+    return digest.hexdigest()
+
+
+def get_attack_params(attack):
+    # Underscored attributes are run-time state (such as the steps executed by the last call), not parameters
+    # Clamping bounds are derived from the fingerprinted dataset and only set once the attack runs
+    return {key: value for key, value in vars(attack).items() if key not in ['device', 'bounds'] and not key.startswith('_') and (value is None or isinstance(value, (bool, int, float, str)))}
+
+
+def get_attack_cache_key(attack, dataset, train, use_labels, chunk_size, seed, workers=1):
+    # Everything the perturbed samples depend on: attacked weights, attack hyperparameters, seed and the exact clean inputs
+    description = {
+        'model': get_model_fingerprint(attack.model) if hasattr(attack, 'model') else None,
+        'attack': attack.__class__.__name__,
+        'code': get_attack_code_fingerprint(attack),
+        'params': get_attack_params(attack),
+        'seed': seed,
+        'dataset': fingerprint_file(dataset._get_data_path(train), get_cache_root(dataset.dataset_dir)),
+        'recipe': dataset._get_normalization_recipe(),
+        'modalities': dataset._get_loaded_modalities(),
+        'use_labels': use_labels,
+        'chunk_size': chunk_size,
+        'workers': workers
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:32], description
+
+
+def run_cached_attack(attack, dataset, train, use_labels=True, chunk_size=1024, seed=None, workers=1):
+    target_modality = attack.target_modality
+    if target_modality is None:
+        return None
+
+    key, description = get_attack_cache_key(attack, dataset, train, use_labels, chunk_size, seed, workers)
+    cache_dir = os.path.join(dataset.dataset_dir, ATTACK_CACHE_DIRNAME, key)
+    if os.path.isfile(os.path.join(cache_dir, MANIFEST_FILENAME)):
+        with open(os.path.join(cache_dir, MANIFEST_FILENAME), 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        dataset._set_modality(target_modality, load_mmap_array(cache_dir, manifest['entry']))
+        print(f"{attack.name} adversarial samples loaded from {cache_dir}")
+        return manifest['stats']
+
+    # Concurrent runs of the same attack may miss at the same time, so each one writes a private directory and renames it
+    tmp_dir = cache_dir + f".{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    stats = run_attack_farm(attack, dataset, use_labels, chunk_size, workers, os.path.join(tmp_dir, f"{target_modality}.npy"), seed)
+    entry = {'file': f"{target_modality}.npy", 'shape': list(dataset.dataset[target_modality].size()), 'dtype': 'float32'}
+    with open(os.path.join(tmp_dir, MANIFEST_FILENAME), 'w') as manifest_file:
+        json.dump({'key': description, 'entry': entry, 'stats': stats}, manifest_file, indent=4)
+    try:
+        os.replace(tmp_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return stats
@@ -0,0 +1,69 @@
+import time
+import torch
+
+from tqdm import tqdm
+
+
+def _get_class_labels(y):
+    if y.dim() == 2:
+        return torch.argmax(y, dim=-1)
+    return y
+
+
+def _predict(model, x):
+    with torch.no_grad():
+        result, _ = model(x)
+    # A sample is broken when its predicted class changes, which single-output regressors (MOSEI/MOSI) do not have
+    if result.dim() != 2 or result.size(-1) < 2:
+        raise ValueError("Attack ensembles need a classifier with one output per class.")
+    return torch.argmax(result, dim=-1)
+
+
+def _synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def run_attack_ensemble(model, attacks, dataset, chunk_size=1024):
+    # Attacks run in the given order (cheapest first), each one only on the samples that all previous ones failed to break
+    target_modality = attacks[0].target_modality
+    n_samples = dataset._get_stored_len()
+    bounds = dataset._get_bounds(target_modality, chunk_size)
+    for attack in attacks:
+        attack._set_bounds(bounds)
+    out = dataset._allocate_modality(target_modality)
+    n_correct = 0
+    stages = [{'attack': attack.name, 'attacked': 0, 'broken': 0, 'time': 0.} for attack in attacks]
+
+    start_time = time.time()
+    for start in tqdm(range(0, n_samples, chunk_size), total=(n_samples + chunk_size - 1) // chunk_size):
+        end = min(start + chunk_size, n_samples)
+        x, y = dataset._get_chunk(start, end)
+        out[start:end].copy_(x[target_modality])
+        labels = _get_class_labels(y)
+        survivors = torch.nonzero(_predict(model, x) == labels).flatten()
+        n_correct += len(survivors)
+
+        for attack, stage in zip(attacks, stages):
+            if len(survivors) == 0:
+                break
+            stage_start = time.time()
+            x_adv = attack({key: value[survivors] for key, value in x.items()}, y[survivors])
+            broken = _predict(model, x_adv) != labels[survivors]
+            _synchronize(attacks[0].device)
+            stage['time'] += time.time() - stage_start
+            stage['attacked'] += len(survivors)
+            stage['broken'] += int(broken.sum())
+
+            # Broken samples keep the perturbation that broke them, the remaining ones are overwritten by the next attack
+            out[(start + survivors).to(out.device)] = x_adv[target_modality].detach().to(out.device)
+            survivors = survivors[~broken]
+
+    elapsed = time.time() - start_time
+    n_robust = n_correct
+    for stage in stages:
+        n_robust -= stage['broken']
+        stage['robust_accuracy'] = n_robust / max(n_samples, 1)
+
+    dataset._set_modality(target_modality, out)
+    return {'samples': n_samples, 'clean_accuracy': n_correct / max(n_samples, 1), 'robust_accuracy': n_robust / max(n_samples, 1), 'stages': stages, 'time': elapsed}
@@ -0,0 +1,105 @@
+import os
+import time
+import torch
+import shutil
+import tempfile
+import numpy as np
+import multiprocessing
+
+from .attack_runner import run_attack, _allocate_mmap_output
+
+
+# Set right before forking, so workers inherit the frozen classifier and the dataset instead of unpickling them
+_FARM_STATE = {}
+
+
+def _get_worker_cores(worker_id, workers):
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    shard = len(cores) // workers
+    if shard == 0:
+        return cores
+    return cores[worker_id * shard:(worker_id + 1) * shard]
+
+
+def _run_shard(worker_id, workers, start, end, out_path, seed):
+    cores = _get_worker_cores(worker_id, workers)
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    torch.manual_seed(seed + worker_id)
+
+    attack, dataset, use_labels, chunk_size = _FARM_STATE['attack'], _FARM_STATE['dataset'], _FARM_STATE['use_labels'], _FARM_STATE['chunk_size']
+    out_array = np.load(out_path, mmap_mode='r+')
+    out = torch.from_numpy(out_array)
+    for chunk_start in range(start, end, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, end)
+        x, y = dataset._get_chunk(chunk_start, chunk_end)
+        if use_labels:
+            x_adv = attack(x, y)
+        else:
+            x_adv = attack(x)
+        out[chunk_start:chunk_end].copy_(x_adv[attack.target_modality].detach())
+    out_array.flush()
+
+
+def run_attack_farm(attack, dataset, use_labels=True, chunk_size=1024, workers=1, out_path=None, seed=None):
+    # Shards the stored samples across forked CPU workers, each one with its own cores, writing to a shared memory-mapped output
+    target_modality = attack.target_modality
+    if target_modality is None:
+        return None
+    if workers <= 1 or torch.device(attack.device).type != 'cpu' or not hasattr(os, 'fork'):
+        return run_attack(attack, dataset, use_labels, chunk_size, out_path)
+
+    n_samples = dataset._get_stored_len()
+    # Computed once before forking, so every shard clamps to the bounds of the whole modality
+    attack._set_bounds(dataset._get_bounds(target_modality, chunk_size))
+    size = dataset.dataset[target_modality].size()
+    tmp_dir = None
+    if out_path is None:
+        tmp_dir = tempfile.mkdtemp(dir=dataset.dataset_dir)
+        shard_path = os.path.join(tmp_dir, f"{target_modality}.npy")
+    else:
+        shard_path = out_path
+    _allocate_mmap_output(shard_path, size).flush()
+
+    shard_size = (n_samples + workers - 1) // workers
+    # Forked workers inherit the parent's generator state, so without a seed they are seeded from it, each with its own offset
+    seed = seed if seed is not None else torch.initial_seed()
+    start_time = time.time()
+    _FARM_STATE.update({'attack': attack, 'dataset': dataset, 'use_labels': use_labels, 'chunk_size': chunk_size})
+    context = multiprocessing.get_context('fork')
+    processes = []
+    completed = False
+    try:
+        for worker_id in range(workers):
+            start, end = worker_id * shard_size, min((worker_id + 1) * shard_size, n_samples)
+            if start >= end:
+                break
+            process = context.Process(target=_run_shard, args=(worker_id, workers, start, end, shard_path, seed))
+            process.start()
+            processes.append(process)
+        for process in processes:
+            process.join()
+        failed = [worker_id for worker_id, process in enumerate(processes) if process.exitcode != 0]
+        if failed:
+            raise RuntimeError(f"{attack.name} attack farm workers {failed} failed.")
+        completed = True
+    finally:
+        _FARM_STATE.clear()
+        # A failed farm leaves no partially written shard file behind
+        if not completed and tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    elapsed = time.time() - start_time
+    print(f"{attack.name} generated {n_samples} adversarial samples in {elapsed:.2f}s ({n_samples / max(elapsed, 1e-9):.1f} samples/s, {len(processes)} workers, chunk size {chunk_size})")
+
+    out = torch.from_numpy(np.load(shard_path, mmap_mode='r+'))
+    if tmp_dir is not None:
+        # The shards are merged into the dataset's own storage and the shared file is dropped
+        merged = dataset._allocate_modality(target_modality)
+        merged.copy_(out)
+        out = merged
+        os.remove(shard_path)
+        os.rmdir(tmp_dir)
+    dataset._set_modality(target_modality, out)
+    return {'samples': n_samples, 'time': elapsed, 'throughput': n_samples / max(elapsed, 1e-9)}
@@ -0,0 +1,46 @@
+import os
+import time
+import torch
+import numpy as np
+
+from tqdm import tqdm
+
+
+def _allocate_mmap_output(out_path, size):
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    return np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32, shape=tuple(size))
+
+
+def run_attack(attack, dataset, use_labels=True, chunk_size=1024, out_path=None):
+    # Streams the stored samples through the attack chunk by chunk, so peak memory is bounded by the chunk size
+    target_modality = attack.target_modality
+    if target_modality is None:
+        return None
+
+    n_samples = dataset._get_stored_len()
+    attack._set_bounds(dataset._get_bounds(target_modality, chunk_size))
+    if out_path is not None:
+        out_array = _allocate_mmap_output(out_path, dataset.dataset[target_modality].size())
+        out = torch.from_numpy(out_array)
+    else:
+        out = dataset._allocate_modality(target_modality)
+
+    start_time = time.time()
+    for start in tqdm(range(0, n_samples, chunk_size), total=(n_samples + chunk_size - 1) // chunk_size):
+        end = min(start + chunk_size, n_samples)
+        x, y = dataset._get_chunk(start, end)
+        if use_labels:
+            x_adv = attack(x, y)
+        else:
+            x_adv = attack(x)
+        out[start:end].copy_(x_adv[target_modality].detach())
+
+    if torch.device(attack.device).type == 'cuda':
+        torch.cuda.synchronize(attack.device)
+    elapsed = time.time() - start_time
+    print(f"{attack.name} generated {n_samples} adversarial samples in {elapsed:.2f}s ({n_samples / max(elapsed, 1e-9):.1f} samples/s, chunk size {chunk_size})")
+
+    if out_path is not None:
+        out_array.flush()
+    dataset._set_modality(target_modality, out)
+    return {'samples': n_samples, 'time': elapsed, 'throughput': n_samples / max(elapsed, 1e-9)}
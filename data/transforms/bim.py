@@ -6,9 +6,10 @@ from .adversarial_attack import AdversarialAttack
 
 # Code adapted from https://github.com/Harry24k/adversarial-attacks-pytorch/blob/master/torchattacks/attacks/bim.py
 class BIM(AdversarialAttack):
-    def __init__(self, model, device, target_modality, eps=0.1, alpha=2/255, steps=10, targeted=False, attack_mode="default"):
+    def __init__(self, model, device, target_modality, eps=0.1, alpha=2/255, steps=10, early_stop=True, targeted=False, attack_mode="default"):
         super().__init__("BIM", model, device, target_modality, targeted, attack_mode)
         self.eps = eps
+        self.early_stop = early_stop
         self.alpha = alpha
         if steps == 0:
             self.steps = int(min(eps * 255 + 4, 1.25 * eps * 255))
@@ -19,25 +20,44 @@ class BIM(AdversarialAttack):
         x_adv = dict.fromkeys(x)
         for key in x.keys():
             x_adv[key] = x[key].clone().detach().to(self.device)
-            x_adv[key].requires_grad = True
 
         y = y.clone().detach().to(self.device)
         loss = nn.BCEWithLogitsLoss()
         original_x = x_adv[self.target_modality].clone().detach()
-        for _ in range(self.steps):
-            for key in x.keys():
-                x_adv[key].requires_grad = True
-                
-            model_output, _ = self.model(x_adv)
+
+        # Samples that are already adversarial are frozen and dropped, the remaining ones are compacted into a smaller batch
+        active = torch.arange(len(original_x), device=self.device)
+        batch_x = dict(x_adv)
+        class_labels = None
+        for step in range(self.steps):
+            batch_x[self.target_modality] = x_adv[self.target_modality][active].detach()
+            batch_x[self.target_modality].requires_grad = True
+
+            with self._frozen_model():
+                model_output, _ = self.model(batch_x)
+            if step == 0 and self.early_stop:
+                class_labels = self._get_class_labels(y, model_output)
             if y.dim() == 1:
                 y = nn.functional.one_hot(y, model_output.size(dim=-1)).float()
 
-            cost = loss(model_output, y)
-            grad = torch.autograd.grad(cost, x_adv[self.target_modality], retain_graph=False, create_graph=False)[0]
+            cost = loss(model_output, y[active])
+            grad = torch.autograd.grad(cost, batch_x[self.target_modality], retain_graph=False, create_graph=False)[0]
+
+            batch_orig = original_x[active]
+            batch_mod = batch_x[self.target_modality].detach() + self.alpha * grad.sign()
+            a = torch.clamp(batch_orig - self.eps, min=0)
+            b = (batch_mod >= a).float() * batch_mod + (batch_mod < a).float() * a
+            c = (b > batch_orig + self.eps).float() * (batch_orig + self.eps) + (b <= batch_orig + self.eps).float() * b
+            batch_mod = torch.clamp(c, max=1).detach()
+            if class_labels is None:
+                x_adv[self.target_modality] = x_adv[self.target_modality].detach().index_copy(0, active, batch_mod)
+                continue
 
-            x_adv[self.target_modality] = x[self.target_modality] + self.alpha * grad.sign()
-            a = torch.clamp(original_x - self.eps, min=0)
-            b = (x_adv[self.target_modality] >= a).float() * x_adv[self.target_modality] + (x_adv[self.target_modality] < a).float() * a
-            c = (b > original_x + self.eps).float() * (original_x + self.eps) + (b <= original_x + self.eps).float() * b
-            x_adv[self.target_modality] = torch.clamp(c, max=1).detach()
-        return x_adv
\ No newline at end of file
+            done = self._is_successful(model_output.detach(), class_labels[active])
+            x_adv[self.target_modality] = x_adv[self.target_modality].detach().index_copy(0, active[~done], batch_mod[~done])
+            if bool(done.any()):
+                active = active[~done]
+                if len(active) == 0:
+                    break
+                batch_x = {key: x_adv[key][active].detach() for key in x.keys() if key != self.target_modality}
+        return {key: value.detach() for key, value in x_adv.items()}
@@ -6,76 +6,121 @@ from .adversarial_attack import AdversarialAttack
 
 # Code adapted from https://github.com/Harry24k/adversarial-attacks-pytorch/blob/master/torchattacks/attacks/cw.py#L123
 class CW(AdversarialAttack):
-    def __init__(self, name, model, device, target_modality, c_val=0.1, kappa=10, learning_rate=0.001, steps=10, targeted=False, attack_mode="default"):
-        super().__init__(name, model, device, target_modality, targeted, attack_mode)
+    def __init__(self, model, device, target_modality, c_val=0.1, kappa=10, learning_rate=0.001, steps=10, search_steps=1, early_stop=True, targeted=False, attack_mode="default"):
+        super().__init__("CW", model, device, target_modality, targeted, attack_mode)
         self.c_val = c_val
         self.steps = steps
+        self.search_steps = search_steps
         self.kappa = kappa
         self.learning_rate = learning_rate
+        self.early_stop = early_stop
+        self._executed_steps = 0
 
-    def __call__(self, x, y):
+    def __call__(self, x, y=None):
         adv_x = dict.fromkeys(x)
         for key in x.keys():
             adv_x[key] = x[key].clone().detach().to(self.device)
+        x_mod = adv_x[self.target_modality].clone()
 
         if y is not None:
             y = y.clone().detach().to(self.device)
-            loss = nn.BCEWithLogitsLoss().to(self.device)
             if self.targeted:
-                target_labels = self._get_target_label(adv_x, y)
+                labels = self._get_target_label(adv_x, y)
+            else:
+                labels = y
+            if labels.dim() > 1:
+                labels = torch.argmax(labels, dim=-1)
         else:
-            loss = nn.MSELoss(reduction='none').to(self.device)
+            labels = None
+
+        best_adv_mod = x_mod.clone()
+        best_L2_dist = 1e10 * torch.ones(len(x_mod), device=self.device)
+
+        # Binary search over a per-sample c, every round optimizes the whole batch at once with its own constants
+        c_val = torch.full((len(x_mod),), float(self.c_val), device=self.device)
+        lower_bound = torch.zeros_like(c_val)
+        upper_bound = torch.full_like(c_val, 1e10)
+        # The batch can stop before self.steps when its cost rises, so the optimization steps actually run are counted
+        self._executed_steps = 0
+        for _ in range(self.search_steps):
+            succeeded = self._optimize(adv_x, x_mod, labels, c_val, best_adv_mod, best_L2_dist)
+            upper_bound = torch.where(succeeded, torch.minimum(upper_bound, c_val), upper_bound)
+            lower_bound = torch.where(succeeded, lower_bound, torch.maximum(lower_bound, c_val))
+            c_val = torch.where(upper_bound < 1e9, (lower_bound + upper_bound) / 2, c_val * 10)
+
+        adv_x[self.target_modality] = best_adv_mod
+        return adv_x
 
+    def _optimize(self, adv_x, x_mod, labels, c_val, best_adv_mod, best_L2_dist):
         # w = torch.zeros_like(images).detach() # Requires 2x times
-        w = self._inverse_tanh_space(adv_x[self.target_modality]).detach().to(self.device)
+        w = self._inverse_tanh_space(x_mod).detach().to(self.device)
         w.requires_grad = True
 
-        best_adv_mod = adv_x[self.target_modality].clone().detach().to(self.device)
-        best_L2_dist = 1e10 * torch.ones((len(adv_x[self.target_modality]))).to(self.device)
-        prev_cost = 1e10
-        x_dim = len(adv_x[self.target_modality].shape)
+        succeeded = torch.zeros(len(x_mod), dtype=torch.bool, device=self.device)
+        prev_cost = 1e10 * torch.ones(len(x_mod), device=self.device)
+        prev_batch_cost = 1e10
 
+        mse = nn.MSELoss(reduction='none')
         flatten = nn.Flatten()
         optimizer = torch.optim.Adam([w], lr=self.learning_rate)
+        # Samples whose own cost stops decreasing are frozen and dropped, the remaining ones are compacted into a smaller batch
+        active = torch.arange(len(x_mod), device=self.device)
+        batch_x = {key: value for key, value in adv_x.items() if key != self.target_modality}
         for step in range(self.steps):
+            self._executed_steps += 1
             # Get adversarial modality
-            adv_x[self.target_modality] = self._tanh_space(w)
+            batch_mod = self._tanh_space(w[active])
+            batch_x[self.target_modality] = batch_mod
 
             # Calculate loss values
-            current_L2 = loss(flatten(adv_x[self.target_modality], flatten(x[self.target_modality])))
-            L2_loss = current_L2.sum()
-            result, _ = self.model(adv_x)
-            if self.targeted:
-                f_loss = self._f_function(result, target_labels).sum()
+            current_L2 = mse(flatten(batch_mod), flatten(x_mod[active])).sum(dim=1)
+            with self._frozen_model():
+                result, _ = self.model(batch_x)
+            if labels is not None:
+                cost = current_L2 + c_val[active] * self._f_function(result, labels[active])
             else:
-                f_loss = self._f_function(result, y).sum()
-
-            cost = L2_loss + self.c_val * f_loss
+                # Without labels the attack pushes the reconstruction of the target modality away from the clean input
+                cost = current_L2 - c_val[active] * mse(flatten(result[self.target_modality]), flatten(x_mod[active])).mean(dim=1)
             optimizer.zero_grad()
-            cost.backward()
+            cost.sum().backward()
             optimizer.step()
-            preds = torch.argmax(result.detach(), 1)
-            if self.targeted:
-                condition = (preds == target_labels).float()
+
+            if labels is not None:
+                preds = torch.argmax(result.detach(), 1)
+                if self.targeted:
+                    condition = preds == labels[active]
+                else:
+                    condition = preds != labels[active]
+                score = current_L2.detach()
             else:
-                condition = (preds != y).float()
+                # There is no misclassification to check, so the perturbation with the lowest cost is kept
+                condition = torch.ones(len(active), dtype=torch.bool, device=self.device)
+                score = cost.detach()
+            succeeded[active[condition]] = True
 
-            # Filter out images that get either correct predictions or non-decreasing loss,
-            # i.e., only images that are both misclassified and loss-decreasing are left
-            mask = condition * (best_L2_dist > current_L2.detach())
-            best_L2_dist = mask * current_L2.detach() + (1 - mask) * best_adv_mod
-            mask = mask.view([-1] + [1] * (x_dim - 1))
-            best_adv_mod = mask * adv_x[self.target_modality].detach() + (1 - mask) * best_adv_mod
+            # Keep, per sample, the smallest perturbation that is misclassified
+            improved = condition & (best_L2_dist[active] > score)
+            best_L2_dist[active[improved]] = score[improved]
+            best_adv_mod[active[improved]] = batch_mod.detach()[improved]
 
             # Early stop when loss does not converge.
             if step % max(self.steps//10, 1) == 0:
-                if cost.item() > prev_cost:
-                    adv_x[self.target_modality] = best_adv_mod
-                    return adv_x
-                prev_cost = cost.item()
-
-        adv_x[self.target_modality] = best_adv_mod
-        return adv_x
+                cost = cost.detach()
+                if not self.early_stop:
+                    if cost.sum().item() > prev_batch_cost:
+                        break
+                    prev_batch_cost = cost.sum().item()
+                    continue
+
+                done = cost > prev_cost[active]
+                prev_cost[active] = cost
+                if bool(done.any()):
+                    active = active[~done]
+                    if len(active) == 0:
+                        break
+                    batch_x = {key: adv_x[key][active] for key in adv_x.keys() if key != self.target_modality}
+
+        return succeeded
 
     def _tanh_space(self, x):
         return 1/2*(torch.tanh(x) + 1)    
@@ -91,10 +136,10 @@ class CW(AdversarialAttack):
         one_hot_labels = torch.eye(outputs.shape[1]).to(self.device)[labels]
 
         # find the max logit other than the target class
-        other = torch.max((1 - one_hot_labels) * outputs, dim=1)[0]
+        other = torch.max(outputs.masked_fill(one_hot_labels.bool(), float('-inf')), dim=1)[0]
 
         # get the target class's logit
-        real = torch.max(one_hot_labels * outputs, dim=1)[0]
+        real = torch.sum(one_hot_labels * outputs, dim=1)
         if self.targeted:
             return torch.clamp((other - real), min = -self.kappa)
         else:
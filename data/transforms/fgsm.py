@@ -11,12 +11,26 @@ class FGSM(AdversarialAttack):
         self.eps = eps
 
     def __call__(self, x, y=None):
+        grad_sign = self._get_gradient_sign(x, y)
+        x[self.target_modality] = self._perturb(x[self.target_modality].to(self.device), grad_sign, self.eps).detach()
+        return x
+
+    def sweep(self, x, y, epsilons):
+        # The direction grad.sign() does not depend on eps, so one gradient serves every epsilon of the sweep
+        grad_sign = self._get_gradient_sign(x, y)
+        for eps in epsilons:
+            x_adv = dict(x)
+            x_adv[self.target_modality] = self._perturb(x[self.target_modality].to(self.device), grad_sign, eps).detach()
+            yield eps, x_adv
+
+    def _get_gradient_sign(self, x, y=None):
         x_adv = dict.fromkeys(x)
         for key in x.keys():
             x_adv[key] = x[key].clone().detach().to(self.device)
-            x_adv[key].requires_grad = True
-            
-        result, _ = self.model(x_adv)
+        x_adv[self.target_modality].requires_grad = True
+
+        with self._frozen_model():
+            result, _ = self.model(x_adv)
 
         if y is not None:
             y = y.clone().detach().to(self.device)
@@ -33,10 +47,12 @@ class FGSM(AdversarialAttack):
             cost = (-1) * cost
 
         grad = torch.autograd.grad(cost, x_adv[self.target_modality], retain_graph=False, create_graph=False)[0]
-        x_adv[self.target_modality] = torch.clamp(x_adv[self.target_modality] + self.eps * grad.sign(), torch.min(x_adv[self.target_modality]), torch.max(x_adv[self.target_modality]))
-        
-        x[self.target_modality] = x_adv[self.target_modality].clone().detach().to(self.device)
-        return x
+        return grad.sign()
+
+    def _perturb(self, x_mod, grad_sign, eps):
+        # Without dataset-wide bounds the input itself sets the clamping range
+        lower, upper = self.bounds if self.bounds is not None else (torch.min(x_mod), torch.max(x_mod))
+        return torch.clamp(x_mod + eps * grad_sign, lower, upper)
     
     def __repr__(self):
         return self.__class__.__name__ + '(epsilon={0})'.format(self.eps)
\ No newline at end of file
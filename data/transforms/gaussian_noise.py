@@ -10,7 +10,8 @@ class GaussianNoise(Noise):
     def __call__(self, x, y=None):
         for key in x.keys():
             if key == self.target_modality and self.std > 0:
-                x[key] = torch.clamp(x[key] + torch.randn_like(x[key]) * self.std + self.mean, torch.min(x[key]), torch.max(x[key]))
+                lower, upper = self.bounds if self.bounds is not None else (torch.min(x[key]), torch.max(x[key]))
+                x[key] = torch.clamp(x[key] + torch.randn_like(x[key]) * self.std + self.mean, lower, upper)
             else:
                 x[key] = x[key]
         return x
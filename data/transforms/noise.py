@@ -5,6 +5,7 @@ class Noise(object):
         self.name = name
         self.device = device
         self.target_modality = target_modality
+        self.bounds = None
 
     def __call__(self, x, y=None):
         raise NotImplementedError
@@ -13,4 +14,7 @@ class Noise(object):
         return self.__class__.__name__ + '(mean={0}, std={1})'.format(self.mean, self.std)
     
     def _set_target_modality(self, target_modality):
-        self.target_modality = target_modality
\ No newline at end of file
+        self.target_modality = target_modality
+
+    def _set_bounds(self, bounds):
+        self.bounds = bounds
@@ -6,17 +6,78 @@ from .adversarial_attack import AdversarialAttack
 
 # Code adapted from https://github.com/Harry24k/adversarial-attacks-pytorch/blob/master/torchattacks/attacks/pgd.py
 class PGD(AdversarialAttack):
-    def __init__(self, model, device, target_modality, eps=0.1, alpha=2/255, steps=10, random_start=True, targeted=False, attack_mode="default"):
+    def __init__(self, model, device, target_modality, eps=0.1, alpha=2/255, steps=10, random_start=True, early_stop=True, restarts=1, max_batch_size=None, targeted=False, attack_mode="default"):
         super().__init__("PGD", model, device, target_modality, targeted, attack_mode)
         self.eps = eps
+        self.early_stop = early_stop
+        self.restarts = restarts
+        self.max_batch_size = max_batch_size
         self.steps = steps
         self.alpha = alpha
         self.random_start = random_start
 
     def __call__(self, x, y):
+        if self.restarts > 1:
+            x[self.target_modality] = self._run_restarts(x, y)
+        else:
+            x[self.target_modality] = self._run(x, y)
+        return x
+
+    def _run_restarts(self, x, y):
+        # Restarts are tiled along the batch dimension, so each step is a single forward/backward for all of them
+        n_samples = len(x[self.target_modality])
+        group_size = self.restarts
+        if self.max_batch_size is not None:
+            group_size = max(1, min(self.restarts, self.max_batch_size // n_samples))
+
+        sample_idx = torch.arange(n_samples, device=self.device)
+        best_adv, best_success, best_loss = None, None, None
+        for first in range(0, self.restarts, group_size):
+            n_restarts = min(group_size, self.restarts - first)
+            x_tiled = {key: value.to(self.device).repeat(n_restarts, *[1] * (value.dim() - 1)) for key, value in x.items()}
+            y_tiled = y.to(self.device).repeat(n_restarts, *[1] * (y.dim() - 1)) if y is not None else None
+            adv_mod = self._run(dict(x_tiled), y_tiled)
+            success, loss = self._get_restart_scores(x_tiled, adv_mod, y_tiled)
+            success, loss = success.view(n_restarts, n_samples), loss.view(n_restarts, n_samples)
+            adv_mod = adv_mod.view(n_restarts, n_samples, *adv_mod.size()[1:])
+
+            # Worst case per sample: successful restarts first, then the highest attack loss
+            restart_idx = torch.argmax(success.float() * (loss.max() - loss.min() + 1) + loss, dim=0)
+            group_adv, group_success, group_loss = adv_mod[restart_idx, sample_idx], success[restart_idx, sample_idx], loss[restart_idx, sample_idx]
+            if best_adv is None:
+                best_adv, best_success, best_loss = group_adv, group_success, group_loss
+                continue
+            better = (group_success & ~best_success) | ((group_success == best_success) & (group_loss > best_loss))
+            best_adv[better] = group_adv[better]
+            best_success = best_success | group_success
+            best_loss = torch.where(better, group_loss, best_loss)
+        return best_adv
+
+    def _get_restart_scores(self, x, adv_mod, y):
+        batch_x = dict(x)
+        batch_x[self.target_modality] = adv_mod
+        with torch.no_grad():
+            result, _ = self.model(batch_x)
+        if y is None:
+            loss = nn.functional.mse_loss(result[self.target_modality], adv_mod, reduction='none').flatten(start_dim=1).mean(dim=1)
+            return torch.zeros_like(loss, dtype=torch.bool), loss
+
+        labels = self._get_target_label(batch_x, y) if self.targeted else y
+        class_labels = self._get_class_labels(labels, result)
+        if labels.dim() == 1:
+            labels = nn.functional.one_hot(labels, result.size(dim=-1)).float()
+        loss = nn.functional.binary_cross_entropy_with_logits(result, labels, reduction='none').flatten(start_dim=1).mean(dim=1)
+        if self.targeted:
+            loss = (-1) * loss
+        if class_labels is None:
+            return torch.zeros_like(loss, dtype=torch.bool), loss
+        return self._is_successful(result, class_labels), loss
+
+    def _run(self, x, y):
         adv_x = dict.fromkeys(x)
         for key in x.keys():
             adv_x[key] = x[key].clone().detach().to(self.device)
+        x_mod = x[self.target_modality].to(self.device)
 
         if y is not None:
             y = y.clone().detach().to(self.device)
@@ -31,25 +92,42 @@ class PGD(AdversarialAttack):
             adv_x[self.target_modality] = adv_x[self.target_modality] + torch.empty_like(adv_x[self.target_modality]).uniform_(-self.eps, self.eps)
             adv_x[self.target_modality] = torch.clamp(adv_x[self.target_modality], min=0, max=1).detach()
 
-        for _ in range(self.steps):
-            for key in x.keys():
-                adv_x[key].requires_grad = True
+        # Samples that are already adversarial are frozen and dropped, the remaining ones are compacted into a smaller batch
+        active = torch.arange(len(x_mod), device=self.device)
+        batch_x = dict(adv_x)
+        class_labels = None
+        for step in range(self.steps):
+            batch_x[self.target_modality] = adv_x[self.target_modality][active]
+            batch_x[self.target_modality].requires_grad = True
 
-            result, _ = self.model(adv_x)
+            with self._frozen_model():
+                result, _ = self.model(batch_x)
             if y is not None:
+                if step == 0 and self.early_stop:
+                    class_labels = self._get_class_labels(target_labels if self.targeted else y, result)
                 if y.dim() == 1:
                     y = nn.functional.one_hot(y, result.size(dim=-1)).float()
                 if self.targeted:
-                    cost = (-1) * loss(result, target_labels)
+                    cost = (-1) * loss(result, target_labels[active])
                 else:
-                    cost = loss(result, y)
+                    cost = loss(result, y[active])
             else:
-                cost = loss(result[self.target_modality], adv_x[self.target_modality])
+                cost = loss(result[self.target_modality], batch_x[self.target_modality])
+
+            grad = torch.autograd.grad(cost, batch_x[self.target_modality], retain_graph=False, create_graph=False)[0]
+            batch_mod = batch_x[self.target_modality].detach() + self.alpha * grad.sign()
+            delta = torch.clamp(batch_mod - x_mod[active], min=-self.eps, max=self.eps)
+            batch_mod = torch.clamp(x_mod[active] + delta, min=0, max=1).detach()
+            if class_labels is None:
+                adv_x[self.target_modality][active] = batch_mod
+                continue
 
-            grad = torch.autograd.grad(cost, adv_x[self.target_modality], retain_graph=False, create_graph=False)[0]
-            adv_x[self.target_modality] = adv_x[self.target_modality].detach() + self.alpha * grad.sign()
-            delta = torch.clamp(adv_x[self.target_modality] - x[self.target_modality], min=-self.eps, max=self.eps)
-            adv_x[self.target_modality] = torch.clamp(x[self.target_modality] + delta, min=0, max=1).detach()
+            done = self._is_successful(result.detach(), class_labels[active])
+            adv_x[self.target_modality][active[~done]] = batch_mod[~done]
+            if bool(done.any()):
+                active = active[~done]
+                if len(active) == 0:
+                    break
+                batch_x = {key: adv_x[key][active].detach() for key in x.keys() if key != self.target_modality}
 
-        x[self.target_modality] = adv_x[self.target_modality].clone().detach().to(self.device)
-        return x
\ No newline at end of file
+        return adv_x[self.target_modality].clone().detach().to(self.device)
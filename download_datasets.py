@@ -1,8 +1,176 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 from data.datasets import MhdDataset, MnistSvhnDataset, MoseiDataset, MosiDataset, PendulumDataset
+from data.datasets.mmap_storage import MANIFEST_FILENAME, get_mmap_dir, load_mmap_manifest
+from data.datasets.dataset_cache import get_cache_root, fingerprint_file
+
+
+DATASET_CLASSES = {
+    'mhd': MhdDataset,
+    'mnist_svhn': MnistSvhnDataset,
+    'mosei': MoseiDataset,
+    'mosi': MosiDataset,
+    'pendulum': PendulumDataset
+}
+STATE_FILENAME = "prepare_state.json"
+
+
+def get_dataset_dir(m_path, dataset_name):
+    return os.path.join(m_path, "datasets", dataset_name)
+
+
+def get_source_paths(m_path, dataset_name):
+    # The .pt files produced by the download stage are the ones the datasets load from
+    holder = SimpleNamespace(dataset_dir=get_dataset_dir(m_path, dataset_name))
+    return [DATASET_CLASSES[dataset_name]._get_data_path(holder, train) for train in [True, False]]
+
+
+def get_mmap_paths(m_path, dataset_name, train):
+    mmap_dir = get_mmap_dir(get_dataset_dir(m_path, dataset_name), train)
+    manifest = load_mmap_manifest(mmap_dir)
+    entries = list(manifest['modalities'].values()) + ([manifest['labels']] if manifest['labels'] is not None else [])
+    return [os.path.join(mmap_dir, entry['file']) for entry in entries] + [os.path.join(mmap_dir, MANIFEST_FILENAME)]
+
+
+def load_state(dataset_dir):
+    state_path = os.path.join(dataset_dir, STATE_FILENAME)
+    if not os.path.isfile(state_path):
+        return {}
+    with open(state_path, 'r') as state_file:
+        return json.load(state_file)
+
+
+def save_state(dataset_dir, state):
+    state_path = os.path.join(dataset_dir, STATE_FILENAME)
+    tmp_path = state_path + f".{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as state_file:
+        json.dump(state, state_file, indent=4)
+    os.replace(tmp_path, state_path)
+
+
+def get_checksums(dataset_dir, paths):
+    cache_root = get_cache_root(dataset_dir)
+    return {os.path.relpath(path, dataset_dir): fingerprint_file(path, cache_root) for path in paths}
+
+
+def is_stage_done(dataset_dir, record, input_paths):
+    # A stage is up to date when its recorded inputs and outputs still exist with the same checksums
+    if record is None:
+        return False
+    for checksums in [record['inputs'], record['outputs']]:
+        for path, sha256 in checksums.items():
+            path = os.path.join(dataset_dir, path)
+            if not os.path.isfile(path) or fingerprint_file(path, get_cache_root(dataset_dir)) != sha256:
+                return False
+    return sorted(record['inputs'].keys()) == sorted(os.path.relpath(path, dataset_dir) for path in input_paths)
+
+
+def fetch_from_source(source_dir, m_path, dataset_name):
+    # Local stand-in for the remote sources: the prepared .pt files are copied from source_dir/<dataset>
+    for path in get_source_paths(m_path, dataset_name):
+        tmp_path = path + f".{os.getpid()}.tmp"
+        shutil.copyfile(os.path.join(source_dir, dataset_name, os.path.basename(path)), tmp_path)
+        os.replace(tmp_path, path)
+
+
+def convert_to_mmap(m_path, dataset_name, train):
+    dataset = DATASET_CLASSES[dataset_name](dataset_name, get_dataset_dir(m_path, dataset_name), 'cpu', train=train)
+    dataset._export_mmap(train)
+
+
+def run_stage(dataset_dir, dataset_name, state, timings, stage, run, input_paths, get_output_paths, force=False):
+    start = time.time()
+    if not force and is_stage_done(dataset_dir, state.get(stage), input_paths):
+        timings.append((dataset_name, stage, 'skipped', time.time() - start))
+        return
+    # Stages are only recorded once finished, so an interrupted run redoes exactly the unfinished ones
+    state.pop(stage, None)
+    save_state(dataset_dir, state)
+    run()
+    state[stage] = {'inputs': get_checksums(dataset_dir, input_paths), 'outputs': get_checksums(dataset_dir, get_output_paths())}
+    save_state(dataset_dir, state)
+    timings.append((dataset_name, stage, 'done', time.time() - start))
+
+
+def download_dataset(m_path, dataset_name, source_dir=None, force=False):
+    dataset_dir = get_dataset_dir(m_path, dataset_name)
+    os.makedirs(dataset_dir, exist_ok=True)
+    # The download scripts resolve their paths from the working directory
+    cwd = os.getcwd()
+    os.chdir(m_path)
+    try:
+        timings = []
+        if source_dir is not None:
+            download = lambda: fetch_from_source(source_dir, m_path, dataset_name)
+        else:
+            download = DATASET_CLASSES[dataset_name]._download
+        run_stage(dataset_dir, dataset_name, load_state(dataset_dir), timings, 'download', download, [], lambda: get_source_paths(m_path, dataset_name), force)
+        return timings
+    finally:
+        os.chdir(cwd)
+
+
+def convert_dataset(m_path, dataset_name, force=False):
+    # Runs in a worker process
+    os.chdir(m_path)
+    dataset_dir = get_dataset_dir(m_path, dataset_name)
+    state = load_state(dataset_dir)
+    timings = []
+    for train in [True, False]:
+        run_stage(dataset_dir, dataset_name, state, timings, f"mmap_{'train' if train else 'test'}", lambda: convert_to_mmap(m_path, dataset_name, train), get_source_paths(m_path, dataset_name), lambda: get_mmap_paths(m_path, dataset_name, train), force)
+    return timings
+
+
+def prepare_datasets(m_path, dataset_names, workers=None, source_dir=None, force=False):
+    timings = []
+    failed = []
+    # Downloads run one at a time, the Google Drive scripts all share /tmp/cookies.txt
+    downloaded = []
+    for dataset_name in dataset_names:
+        try:
+            timings.extend(download_dataset(m_path, dataset_name, source_dir, force))
+            downloaded.append(dataset_name)
+        except Exception as exception:
+            print(f"Download of {dataset_name} failed: {exception}")
+            failed.append(dataset_name)
+
+    if not downloaded:
+        return timings, failed
+    with ProcessPoolExecutor(max_workers=workers or len(downloaded)) as executor:
+        futures = {executor.submit(convert_dataset, m_path, dataset_name, force): dataset_name for dataset_name in downloaded}
+        for future in as_completed(futures):
+            try:
+                timings.extend(future.result())
+            except Exception as exception:
+                print(f"Preparation of {futures[future]} failed: {exception}")
+                failed.append(futures[future])
+    return timings, failed
+
+
+def print_timings(timings, total_time):
+    print(f"{'dataset':<12}{'stage':<12}{'status':<10}{'time (s)':>10}")
+    for dataset_name, stage, status, stage_time in sorted(timings):
+        print(f"{dataset_name:<12}{stage:<12}{status:<10}{stage_time:>10.2f}")
+    print(f"Total wall time: {total_time:.2f}s")
+
 
 if __name__ == '__main__':
-    MhdDataset._download()
-    MnistSvhnDataset._download()
-    MoseiDataset._download()
-    MosiDataset._download()
-    PendulumDataset._download()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Downloads and prepares the datasets.')
+    parser.add_argument('--datasets', nargs='+', default=list(DATASET_CLASSES.keys()), choices=list(DATASET_CLASSES.keys()), help='Datasets to prepare.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of datasets converted concurrently (defaults to one process per dataset), downloads always run one at a time.')
+    parser.add_argument('--source_dir', type=str, default=None, help='Local directory with the prepared .pt files of each dataset (source_dir/<dataset>/), used instead of downloading.')
+    parser.add_argument('--force', action='store_true', help='Redoes every stage even if its outputs are up to date.')
+    args = parser.parse_args()
+
+    start = time.time()
+    timings, failed = prepare_datasets(os.getcwd(), args.datasets, args.workers, args.source_dir, args.force)
+    print_timings(timings, time.time() - start)
+    if failed:
+        sys.exit(1)
@@ -6,7 +6,7 @@ import wandb
 import traceback
 
 from utils.train import run_training
-from utils.test import run_test, run_inference
+from utils.test import run_test, run_inference, run_fgsm_sweep, run_noise_sweep, run_attack_ensemble_test
 from utils.command_parser import process_arguments
 from utils.setup import setup_experiment, setup_env, setup_device
 
@@ -42,7 +42,14 @@ def test_model(config, device):
 
 def test_downstream_classifier(config, device):
     dataset, model, _ = setup_experiment(m_path, config, device, train=False)
-    run_test(m_path, config, device, model, dataset)
+    if config['adv_ensemble'] is not None:
+        run_attack_ensemble_test(m_path, config, device, model, dataset)
+    elif config['adversarial_attack'] == 'fgsm' and config['adv_epsilons'] is not None:
+        run_fgsm_sweep(m_path, config, device, model, dataset)
+    elif config['adversarial_attack'] == 'gaussian_noise' and config['noise_stds'] is not None:
+        run_noise_sweep(m_path, config, device, model, dataset)
+    else:
+        run_test(m_path, config, device, model, dataset)
 
 
 def inference(config, device):
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tests import the top-level scripts (such as download_datasets.py) from the repository root, wherever pytest is run from
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
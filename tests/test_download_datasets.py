@@ -0,0 +1,71 @@
+import os
+import time
+import torch
+import pytest
+
+import download_datasets
+
+
+N_SAMPLES = 16
+
+
+@pytest.fixture
+def source_dir(tmp_path):
+    # Local stand-ins for the remote sources, in the format of the prepared .pt files
+    source_dir = tmp_path / "sources"
+    os.makedirs(source_dir / "mhd")
+    os.makedirs(source_dir / "mnist_svhn")
+    for split in ['train', 'test']:
+        torch.save([torch.randint(0, 10, (N_SAMPLES,)), torch.rand(N_SAMPLES, 1, 28, 28), torch.randn(N_SAMPLES, 200), torch.randn(N_SAMPLES, 4, 32, 32), {'max': 1.0, 'min': 0.0}, {'max': 2.0, 'min': -1.0}],
+                   source_dir / "mhd" / f"mhd_{split}.pt")
+        torch.save({'mnist': torch.randint(0, 255, (N_SAMPLES, 1, 28, 28), dtype=torch.uint8), 'svhn': torch.randint(0, 255, (N_SAMPLES, 3, 32, 32), dtype=torch.uint8), 'labels': torch.randint(0, 10, (N_SAMPLES,))},
+                   source_dir / "mnist_svhn" / f"mnist_svhn_{split}.pt")
+    return str(source_dir)
+
+
+def get_statuses(timings):
+    return {(dataset_name, stage): status for dataset_name, stage, status, _ in timings}
+
+
+def test_prepare_datasets_from_local_sources(tmp_path, source_dir):
+    m_path = str(tmp_path / "root")
+    timings, failed = download_datasets.prepare_datasets(m_path, ['mhd', 'mnist_svhn'], source_dir=source_dir)
+    assert failed == []
+    assert set(get_statuses(timings).values()) == {'done'}
+    for dataset_name in ['mhd', 'mnist_svhn']:
+        dataset_dir = download_datasets.get_dataset_dir(m_path, dataset_name)
+        assert sorted(download_datasets.load_state(dataset_dir).keys()) == ['download', 'mmap_test', 'mmap_train']
+        for train in [True, False]:
+            assert all(os.path.isfile(path) for path in download_datasets.get_mmap_paths(m_path, dataset_name, train))
+
+    timings, failed = download_datasets.prepare_datasets(m_path, ['mhd', 'mnist_svhn'], source_dir=source_dir)
+    assert failed == []
+    assert set(get_statuses(timings).values()) == {'skipped'}
+
+
+def test_prepare_datasets_resumes_interrupted_conversion(tmp_path, source_dir):
+    m_path = str(tmp_path / "root")
+    download_datasets.prepare_datasets(m_path, ['mhd'], source_dir=source_dir)
+    os.remove(download_datasets.get_mmap_paths(m_path, 'mhd', False)[-1])
+
+    timings, failed = download_datasets.prepare_datasets(m_path, ['mhd'], source_dir=source_dir)
+    assert failed == []
+    assert get_statuses(timings) == {('mhd', 'download'): 'skipped', ('mhd', 'mmap_train'): 'skipped', ('mhd', 'mmap_test'): 'done'}
+
+
+def test_prepare_datasets_downloads_one_at_a_time(tmp_path, source_dir, monkeypatch):
+    active = []
+    overlaps = []
+    fetch_from_source = download_datasets.fetch_from_source
+
+    def fetch_and_record(*args):
+        overlaps.append(len(active))
+        active.append(args)
+        time.sleep(0.05)
+        fetch_from_source(*args)
+        active.remove(args)
+
+    monkeypatch.setattr(download_datasets, 'fetch_from_source', fetch_and_record)
+    _, failed = download_datasets.prepare_datasets(str(tmp_path / "root"), ['mhd', 'mnist_svhn'], source_dir=source_dir)
+    assert failed == []
+    assert overlaps == [0, 0]
@@ -16,8 +16,12 @@ TIMEOUT = 0 # Seconds to wait for user to input notes
 ARCHITECTURES = ['vae', 'dae', 'mvae', 'cmvae', 'cmdvae', 'mdae', 'cmdae', 'gmc', 'dgmc', 'gmcwd', 'rgmc']
 DATASETS = ['mhd', 'mnist_svhn', 'mosi', 'mosei']
 OPTIMIZERS = ['sgd', 'adam', None]
-ADVERSARIAL_ATTACKS = ["gaussian_noise", "fgsm", "pgd", "bim", None]
+ADVERSARIAL_ATTACKS = ["gaussian_noise", "fgsm", "pgd", "bim", "cw", None]
 EXPERTS_FUSION_TYPES = ['poe', 'moe', None]
+DATA_LOADERS = ['batch', 'default']
+DATASET_STORAGES = ['pt', 'mmap']
+DATASET_DTYPES = ['float32', 'compact']
+ADV_STORAGES = ['memory', 'mmap']
 STAGES = ['train_model', 'train_classifier', 'train_supervised', 'train_rl', 'test_model', 'test_classifier', 'inference']
 MODALITIES = {
     'mhd': ['image', 'trajectory', 'sound'],
@@ -30,10 +34,23 @@ SEED = 42
 LR_DEFAULT = 0.001
 EPOCHS_DEFAULT = 100
 BATCH_SIZE_DEFAULT = 64
+DATA_LOADER_DEFAULT = 'batch'
+DATASET_STORAGE_DEFAULT = 'pt'
+DATASET_CACHE_DEFAULT = False
+DATASET_DTYPE_DEFAULT = 'float32'
+PIN_MEMORY_DEFAULT = False
+DATA_MULTIPLIER_DEFAULT = 1
+BUCKET_BATCHES_DEFAULT = False
+ADV_CHUNK_SIZE_DEFAULT = 1024
+ADV_STORAGE_DEFAULT = 'memory'
+ADV_CACHE_DEFAULT = False
+ADV_WORKERS_DEFAULT = 1
 CHECKPOINT_DEFAULT = 0
 LATENT_DIM_DEFAULT = 64
 COMMON_DIM_DEFAULT = 64
 INFONCE_TEMPERATURE_DEFAULT = 0.1
+GMC_QUEUE_MOMENTUM_DEFAULT = 0.999
+SHARED_TRUNK_DEFAULT = False
 KLD_BETA_DEFAULT = 0.5
 REPARAMETERIZATION_MEAN_DEFAULT = 0.0
 REPARAMETERIZATION_STD_DEFAULT = 1.0
@@ -49,6 +66,9 @@ ADV_ALPHA_DEFAULT = 25 / 255
 ADV_STEPS_DEFAULT = 10
 ADV_KAPPA_DEFAULT = 10
 ADV_LR_DEFAULT = 0.001
+ADV_EARLY_STOP_DEFAULT = True
+ADV_RESTARTS_DEFAULT = 1
+ADV_SEARCH_STEPS_DEFAULT = 1
 RECON_SCALE_DEFAULTS = {
     'mhd': {'image': 0.5, 'trajectory': 0.5, 'sound': 0.0}, 
     'mnist_svhn': {'mnist': 0.5, 'svhn': 0.5},
@@ -64,6 +84,17 @@ class CommandParser(argparse.ArgumentParser):
         sys.exit(2)
 
 
+def str2bool(value):
+    # type=bool turns any non-empty string, "False" included, into True
+    if isinstance(value, bool):
+        return value
+    if value.lower() in ('true', 't', 'yes', 'y', '1'):
+        return True
+    if value.lower() in ('false', 'f', 'no', 'n', '0'):
+        return False
+    raise argparse.ArgumentTypeError(f"Boolean value expected, got {value}.")
+
+
 def process_arguments(m_path):
     parser = CommandParser(prog="rgmc", description="Program to test the performance and robustness of several different models with clean and noisy/adversarial samples.")
     subparsers = parser.add_subparsers(help="command", dest="command")
@@ -110,6 +141,7 @@ def process_arguments(m_path):
     exp_parser.add_argument('-r', '--learning_rate', '--lr', type=float, default=LR_DEFAULT, help='Learning rate value for the optimizer.')
     exp_parser.add_argument('-e', '--epochs', type=int, default=EPOCHS_DEFAULT, help='Number of epochs to train the model.')
     exp_parser.add_argument('-b', '--batch_size', type=int, default=BATCH_SIZE_DEFAULT, help='Number of samples processed for each model update.')
+    exp_parser.add_argument('--data_loader', type=str, default=DATA_LOADER_DEFAULT, choices=DATA_LOADERS, help='Batch loading mode: index whole batches from the dataset tensors (batch) or use the per-sample torch DataLoader (default).')
     exp_parser.add_argument('--checkpoint', type=int, default=CHECKPOINT_DEFAULT, help='Epoch interval between checkpoints of the model in training.')
     exp_parser.add_argument('--latent_dimension', '--latent_dim', type=int, default=LATENT_DIM_DEFAULT, help='Dimension of the latent space of the models encodings.')
     exp_parser.add_argument('--common_dimension', '--common_dim', type=int, default=COMMON_DIM_DEFAULT, help='Dimension of the common representation space of the models based on GMC.')
@@ -117,6 +149,10 @@ def process_arguments(m_path):
     exp_parser.add_argument('--target_modality', type=str, default=None, help='Modality to target with noisy and/or adversarial samples.')
     exp_parser.add_argument('--exclude_modality', type=str, default=None, help='Exclude a modality from the training/testing process.')
     exp_parser.add_argument('--infonce_temperature', '--infonce_temp', type=float, default=INFONCE_TEMPERATURE_DEFAULT, help='Temperature for the infonce loss.')
+    exp_parser.add_argument('--infonce_block_size', type=int, default=None, help='Rows of the similarity matrix computed at a time by the infonce loss of the GMC models (mhd and mnist_svhn), bounds its memory for large batch sizes.')
+    exp_parser.add_argument('--gmc_queue_size', type=int, default=None, help='Size of the queue of past representations used as extra negatives when training the GMC models (mhd and mnist_svhn).')
+    exp_parser.add_argument('--gmc_queue_momentum', type=float, default=GMC_QUEUE_MOMENTUM_DEFAULT, help='Momentum of the encoder copy that produces the queued representations.')
+    exp_parser.add_argument('--shared_trunk', type=str2bool, default=SHARED_TRUNK_DEFAULT, help='If true, the joint processor of the GMC models (mhd and mnist_svhn) consumes the features of the unimodal processors instead of its own copies of their stacks.')
     exp_parser.add_argument('--image_recon_scale', type=float, default=RECON_SCALE_DEFAULTS['mhd']['image'], help='Weight for the image reconstruction loss.')
     exp_parser.add_argument('--traj_recon_scale', type=float, default=RECON_SCALE_DEFAULTS['mhd']['trajectory'], help='Weight for the trajectory reconstruction loss.')
     exp_parser.add_argument('--sound_recon_scale', type=float, default=RECON_SCALE_DEFAULTS['mhd']['sound'], help='Weight for the sound reconstruction loss.')
@@ -136,9 +172,26 @@ def process_arguments(m_path):
     exp_parser.add_argument('--adam_betas', nargs=2, type=float, default=ADAM_BETAS_DEFAULTS, help='Beta values for the Adam optimizer.')
     exp_parser.add_argument('--momentum', type=float, default=MOMENTUM_DEFAULT, help='Momentum for the SGD optimizer.')
     exp_parser.add_argument('--noise_std', type=float, default=NOISE_STD_DEFAULT, help='Standard deviation for noise distribution.')
+    exp_parser.add_argument('--noise_stds', type=float, nargs='+', default=None, help='List of noise standard deviations evaluated when testing a classifier against gaussian_noise, reusing the clean features of the other modalities.')
     exp_parser.add_argument('--adv_epsilon', type=float, default=ADV_EPSILON_DEFAULT, help='Epsilon value for adversarial example generation.')
+    exp_parser.add_argument('--adv_early_stop', type=str2bool, default=ADV_EARLY_STOP_DEFAULT, help='If true (default), iterative attacks (pgd, bim, cw) stop perturbing each sample as soon as it succeeds or stops converging; False runs every sample for all steps as before.')
+    exp_parser.add_argument('--adv_restarts', type=int, default=ADV_RESTARTS_DEFAULT, help='Number of random restarts of the pgd attack, run together in one tiled batch and keeping the worst case per sample.')
+    exp_parser.add_argument('--adv_max_batch', type=int, default=None, help='Maximum number of tiled samples per pgd pass, restarts beyond it are run in sequential groups (defaults to all restarts at once).')
+    exp_parser.add_argument('--adv_search_steps', type=int, default=ADV_SEARCH_STEPS_DEFAULT, help='Number of binary search rounds over the per-sample constant c of the cw attack (adv_epsilon is the initial c).')
+    exp_parser.add_argument('--adv_ensemble', type=str, nargs='+', default=None, choices=ADVERSARIAL_ATTACKS[:-1], help='Ordered list of attacks (cheapest first) run when testing a classifier, each one only on the samples that are still classified correctly.')
+    exp_parser.add_argument('--adv_epsilons', type=float, nargs='+', default=None, help='List of epsilon values evaluated in a single pass when testing a classifier against fgsm (one gradient per batch).')
+    exp_parser.add_argument('--adv_chunk_size', type=int, default=ADV_CHUNK_SIZE_DEFAULT, help='Number of samples perturbed at once when generating an adversarial dataset.')
+    exp_parser.add_argument('--adv_storage', type=str, default=ADV_STORAGE_DEFAULT, choices=ADV_STORAGES, help='Where the perturbed modality is written: preallocated tensor (memory) or memory-mapped file under datasets/<dataset>/adversarial (mmap).')
+    exp_parser.add_argument('--adv_workers', type=int, default=ADV_WORKERS_DEFAULT, help='Number of CPU worker processes that generate shards of the adversarial dataset in parallel (only used when attacking on the cpu).')
+    exp_parser.add_argument('--adv_cache', type=str2bool, default=ADV_CACHE_DEFAULT, help='If true, reuses adversarial datasets cached under datasets/<dataset>/adversarial_cache for the same classifier weights, attack parameters, seed and data. Disabled by default.')
     exp_parser.add_argument('--black_box', action="store_true", help='Defines if an adversarial attack is performed in a black-box setting.')
     exp_parser.add_argument('--wandb', type=bool, default=False, help='If true, activates weights and biases logging.')
+    exp_parser.add_argument('--dataset_storage', type=str, default=DATASET_STORAGE_DEFAULT, choices=DATASET_STORAGES, help='On-disk dataset format to load: monolithic torch file (pt) or per-modality memory-mapped arrays (mmap).')
+    exp_parser.add_argument('--dataset_cache', type=str2bool, default=DATASET_CACHE_DEFAULT, help='If true, reuses the normalized dataset cached under datasets/<dataset>/cache (rebuilt whenever the source file changes). Disabled by default.')
+    exp_parser.add_argument('--dataset_dtype', type=str, default=DATASET_DTYPE_DEFAULT, choices=DATASET_DTYPES, help='Resident dtype of the dataset: float32, or compact (uint8 images, float16 sequences) dequantized per batch on the device.')
+    exp_parser.add_argument('--pin_memory', type=str2bool, default=PIN_MEMORY_DEFAULT, help='If true, keeps the dataset in pinned host memory and prefetches batches to the GPU asynchronously (ignored on CPU).')
+    exp_parser.add_argument('--data_multiplier', type=int, default=DATA_MULTIPLIER_DEFAULT, help='Number of digit-preserving random pairings of the MNIST-SVHN dataset (virtual, no data is copied).')
+    exp_parser.add_argument('--bucket_batches', type=str2bool, default=BUCKET_BATCHES_DEFAULT, help='If true, batches MOSEI/MOSI samples of similar sequence length together so that padding can be trimmed per batch.')
     exp_parser.add_argument('--download', type=bool, default=False, help='If true, downloads the choosen dataset.')
     
     args = vars(parser.parse_args())
@@ -231,13 +284,28 @@ def config_validation(m_path, config):
             config['batch_size'] = BATCH_SIZE_DEFAULT
     if config['batch_size'] < 1:
         raise argparse.ArgumentError("Argument error: batch_size value must be a positive and non-zero integer.")
+    if "data_loader" not in config or config['data_loader'] is None:
+        config['data_loader'] = DATA_LOADER_DEFAULT
+    if config['data_loader'] not in DATA_LOADERS:
+        raise argparse.ArgumentError("Argument error: must define a valid data_loader mode.")
     if "latent_dimension" not in config or config['latent_dimension'] is None:
         config['latent_dimension'] = LATENT_DIM_DEFAULT
     if config['latent_dimension'] < 1:
         raise argparse.ArgumentError("Argument error: latent_dimension value must be a positive and non-zero integer.")
+    if "infonce_block_size" in config and config['infonce_block_size'] is not None and config['infonce_block_size'] < 1:
+        raise argparse.ArgumentError("Argument error: infonce_block_size value must be a positive and non-zero integer.")
+    if "gmc_queue_size" in config and config['gmc_queue_size'] is not None and config['gmc_queue_size'] < 1:
+        raise argparse.ArgumentError("Argument error: gmc_queue_size value must be a positive and non-zero integer.")
     if "exclude_modality" in config and config['exclude_modality'] is not None and config["exclude_modality"] not in MODALITIES[config['dataset']]:
         raise argparse.ArgumentError("Argument error: must define a valid modality to exclude.")
-    if "adversarial_attack" in config and config['adversarial_attack'] is not None:
+    if "adv_ensemble" in config and config['adv_ensemble'] is not None:
+        if None in config['adv_ensemble'] or any(attack not in ADVERSARIAL_ATTACKS for attack in config['adv_ensemble']):
+            raise argparse.ArgumentError("Argument error: must define valid adversarial attacks for the ensemble.")
+        if config['dataset'] in ['mosei', 'mosi']:
+            raise argparse.ArgumentError("Argument error: attack ensembles need class predictions and are not available for the mosi and mosei regression datasets.")
+        if "target_modality" not in config or config['target_modality'] not in MODALITIES[config['dataset']]:
+            raise argparse.ArgumentError("Argument error: must specify valid target_modality for adversarial attack.")
+    elif "adversarial_attack" in config and config['adversarial_attack'] is not None:
         if config["adversarial_attack"] not in ADVERSARIAL_ATTACKS:
             raise argparse.ArgumentError("Argument error: must define valid adversarial attack.")
         if "target_modality" not in config or config['target_modality'] not in MODALITIES[config['dataset']]:
@@ -323,6 +391,43 @@ def config_validation(m_path, config):
         if "download" not in config:
             config["download"] = None
 
+        if "dataset_storage" not in config or config['dataset_storage'] is None:
+            config['dataset_storage'] = DATASET_STORAGE_DEFAULT
+        if config['dataset_storage'] not in DATASET_STORAGES:
+            raise argparse.ArgumentError("Argument error: must define a valid dataset_storage format.")
+
+        if "dataset_cache" not in config or config['dataset_cache'] is None:
+            config['dataset_cache'] = DATASET_CACHE_DEFAULT
+
+        if "dataset_dtype" not in config or config['dataset_dtype'] is None:
+            config['dataset_dtype'] = DATASET_DTYPE_DEFAULT
+        if config['dataset_dtype'] not in DATASET_DTYPES:
+            raise argparse.ArgumentError("Argument error: must define a valid dataset_dtype.")
+
+        if "pin_memory" not in config or config['pin_memory'] is None:
+            config['pin_memory'] = PIN_MEMORY_DEFAULT
+
+        if "data_multiplier" not in config or config['data_multiplier'] is None:
+            config['data_multiplier'] = DATA_MULTIPLIER_DEFAULT
+
+        if "bucket_batches" not in config or config['bucket_batches'] is None:
+            config['bucket_batches'] = BUCKET_BATCHES_DEFAULT
+
+        if "adv_chunk_size" not in config or config['adv_chunk_size'] is None:
+            config['adv_chunk_size'] = ADV_CHUNK_SIZE_DEFAULT
+        if "adv_storage" not in config or config['adv_storage'] is None:
+            config['adv_storage'] = ADV_STORAGE_DEFAULT
+        if config['adv_storage'] not in ADV_STORAGES:
+            raise argparse.ArgumentError("Argument error: must define a valid adv_storage.")
+        if "adv_epsilons" not in config:
+            config['adv_epsilons'] = None
+        if "noise_stds" not in config:
+            config['noise_stds'] = None
+        if "adv_cache" not in config or config['adv_cache'] is None:
+            config['adv_cache'] = ADV_CACHE_DEFAULT
+        if "adv_workers" not in config or config['adv_workers'] is None:
+            config['adv_workers'] = ADV_WORKERS_DEFAULT
+
         if "ae" in config['architecture'] or config['architecture'] == "dgmc" or config['architecture'] == 'gmcwd':
             if config['dataset'] == "mhd":
                 if "image_recon_scale" not in config:
@@ -491,6 +596,18 @@ def config_validation(m_path, config):
             if "infonce_temperature" not in config:
                 config["infonce_temperature"] = INFONCE_TEMPERATURE_DEFAULT
 
+            if "infonce_block_size" not in config:
+                config["infonce_block_size"] = None
+
+            if "gmc_queue_size" not in config or config['gmc_queue_size'] is None:
+                config['gmc_queue_size'] = None
+                config['gmc_queue_momentum'] = None
+            elif "gmc_queue_momentum" not in config or config['gmc_queue_momentum'] is None:
+                config['gmc_queue_momentum'] = GMC_QUEUE_MOMENTUM_DEFAULT
+
+            if "shared_trunk" not in config or config['shared_trunk'] is None:
+                config['shared_trunk'] = SHARED_TRUNK_DEFAULT
+
             if "common_dimension" not in config or config['common_dimension'] is None:
                 config['common_dimension'] = COMMON_DIM_DEFAULT
             
@@ -499,6 +616,10 @@ def config_validation(m_path, config):
                     config['o3n_loss_scale'] = O3N_LOSS_SCALE_DEFAULT
         else:
             config['infonce_temperature'] = None
+            config['infonce_block_size'] = None
+            config['gmc_queue_size'] = None
+            config['gmc_queue_momentum'] = None
+            config['shared_trunk'] = None
             config['common_dimension'] = None
 
         if config['stage'] == "train_model":
@@ -518,6 +639,10 @@ def config_validation(m_path, config):
             config['imaget_recon_scale'] = None
             config['audiot_recon_scale'] = None
             config['infonce_temperature'] = None
+            config['infonce_block_size'] = None
+            config['gmc_queue_size'] = None
+            config['gmc_queue_momentum'] = None
+            config['shared_trunk'] = None
             config['o3n_loss_scale'] = None
             config['kld_beta'] = None
         
@@ -528,12 +653,15 @@ def config_validation(m_path, config):
         if "adversarial_attack" not in config:
             config["adversarial_attack"] = None
 
-        if config["adversarial_attack"] is None:
+        if "adv_ensemble" not in config:
+            config['adv_ensemble'] = None
+
+        if config["adversarial_attack"] is None and config['adv_ensemble'] is None:
             config["noise_std"] = None
             config['adv_epsilon'] = None
             config['adv_alpha'] = None
             config['adv_steps'] = None
-        else:
+        elif config["adversarial_attack"] is not None:
             if config["adversarial_attack"] == 'gaussian_noise':
                 if "noise_std" not in config or config["noise_std"] is None:
                     config["noise_std"] = NOISE_STD_DEFAULT
@@ -551,15 +679,29 @@ def config_validation(m_path, config):
                 if config["adversarial_attack"] == 'pgd' or config["adversarial_attack"] == 'cw' or config["adversarial_attack"] == 'bim':
                     if 'adv_steps' not in config or config['adv_steps'] is None:
                             config['adv_steps'] = ADV_STEPS_DEFAULT
+                    if 'adv_early_stop' not in config or config['adv_early_stop'] is None:
+                        config['adv_early_stop'] = ADV_EARLY_STOP_DEFAULT
+
+                    if config['adversarial_attack'] == 'pgd':
+                        if 'adv_restarts' not in config or config['adv_restarts'] is None:
+                            config['adv_restarts'] = ADV_RESTARTS_DEFAULT
+                        if 'adv_max_batch' not in config:
+                            config['adv_max_batch'] = None
+                    else:
+                        config['adv_restarts'] = None
+                        config['adv_max_batch'] = None
                     
                     if config['adversarial_attack'] == 'cw':
                         if 'adv_kappa' not in config or config['adv_kappa'] is None:
                             config['adv_kappa'] = ADV_KAPPA_DEFAULT
                         if 'adv_lr' not in config or config['adv_lr'] is None:
                             config['adv_lr'] = ADV_LR_DEFAULT
+                        if 'adv_search_steps' not in config or config['adv_search_steps'] is None:
+                            config['adv_search_steps'] = ADV_SEARCH_STEPS_DEFAULT
                     else:
                         config['adv_kappa'] = None
                         config['adv_lr'] = None
+                        config['adv_search_steps'] = None
 
                     if config["adversarial_attack"] == 'pgd' or config["adversarial_attack"] == 'bim':
                         if 'adv_alpha' not in config or config['adv_alpha'] is None:
@@ -571,6 +713,28 @@ def config_validation(m_path, config):
                     config['adv_steps'] = None
                     config['adv_kappa'] = None
                     config['adv_lr'] = None
+                    config['adv_restarts'] = None
+                    config['adv_max_batch'] = None
+                    config['adv_search_steps'] = None
+
+        if config['adv_ensemble'] is not None:
+            # Every attack of the ensemble needs its hyperparameters, not only the ones of adversarial_attack
+            ensemble_defaults = {
+                'noise_std': NOISE_STD_DEFAULT,
+                'adv_epsilon': ADV_EPSILON_DEFAULT,
+                'adv_alpha': ADV_ALPHA_DEFAULT,
+                'adv_steps': ADV_STEPS_DEFAULT,
+                'adv_kappa': ADV_KAPPA_DEFAULT,
+                'adv_lr': ADV_LR_DEFAULT,
+                'adv_early_stop': ADV_EARLY_STOP_DEFAULT,
+                'adv_restarts': ADV_RESTARTS_DEFAULT,
+                'adv_search_steps': ADV_SEARCH_STEPS_DEFAULT
+            }
+            for key, value in ensemble_defaults.items():
+                if key not in config or config[key] is None:
+                    config[key] = value
+            if 'adv_max_batch' not in config:
+                config['adv_max_batch'] = None
 
         if "optimizer" not in config:
             config["optimizer"] = None
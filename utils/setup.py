@@ -14,14 +14,21 @@ from architectures import (
     AffectGMC, MMClassifier,
     PendulumGMC
 )
-from data.transforms import GaussianNoise, FGSM, BIM, PGD, CW
+from data.transforms import GaussianNoise, FGSM, BIM, PGD, CW, run_attack_farm, run_cached_attack, get_attack_cache_key
 from utils.command_parser import create_idx_dict, config_validation
-from data.datasets import MhdDataset, MnistSvhnDataset, MoseiDataset, MosiDataset, PendulumDataset
+from data.datasets import MhdDataset, MnistSvhnDataset, MoseiDataset, MosiDataset, PendulumDataset, MultimodalDataLoader, LengthBucketBatchSampler
 
 
 idx_lock = threading.Lock()
 device_lock = threading.Lock()
 WAIT_TIME = 0 # Seconds to wait for experimental notes
+DATASET_MODALITIES = {  # Modalities consumed by the architectures of each dataset, the rest are never loaded
+    'mhd': ['image', 'trajectory'],
+    'mnist_svhn': ['mnist', 'svhn'],
+    'mosei': ['text', 'audio', 'vision'],
+    'mosi': ['text', 'audio', 'vision'],
+    'pendulum': None
+}
 
 
 def setup_device(m_path):
@@ -48,6 +55,27 @@ def setup_device(m_path):
     return device
 
 
+def setup_dataloader(config, dataset, batch_size, shuffle=False, drop_last=False):
+    batch_sampler = None
+    if 'bucket_batches' in config and config['bucket_batches'] and hasattr(dataset, '_get_sequence_lengths'):
+        seq_len = dataset.dataset[dataset._get_loaded_modalities()[0]].size(1)
+        batch_sampler = LengthBucketBatchSampler(dataset._get_sequence_lengths(), seq_len, batch_size, shuffle=shuffle, drop_last=drop_last)
+
+    if 'data_loader' in config and config['data_loader'] == 'default':
+        if batch_sampler is not None:
+            return torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler)
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last)
+    return MultimodalDataLoader(dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last, batch_sampler=batch_sampler)
+
+
+def set_batch_padding(model, dataloader=None):
+    # Only length-bucketed loaders trim padding, every other batch (and the attack runner) keeps the full sequences
+    if not hasattr(model, 'set_sequence_padding'):
+        return
+    batch_sampler = getattr(dataloader, 'batch_sampler', None)
+    model.set_sequence_padding(batch_sampler.batch_padding if isinstance(batch_sampler, LengthBucketBatchSampler) else None)
+
+
 def setup_env(m_path, config):
     if torch.cuda.is_available():
         config['device'] = torch.cuda.get_device_name(torch.cuda.current_device())
@@ -102,18 +130,31 @@ def setup_env(m_path, config):
     return config
 
 
+def setup_attack(config, device, model, attack_name, target_modality):
+    if attack_name == 'gaussian_noise':
+        return GaussianNoise(device=device, target_modality=target_modality, std=config['noise_std'])
+    elif attack_name == 'fgsm':
+        return FGSM(device=device, model=model, target_modality=target_modality, eps=config['adv_epsilon'])
+    elif attack_name == 'bim':
+        return BIM(device=device, model=model, target_modality=target_modality, eps=config['adv_epsilon'], alpha=config['adv_alpha'], steps=config['adv_steps'], early_stop=config['adv_early_stop'])
+    elif attack_name == 'pgd':
+        return PGD(device=device, model=model, target_modality=target_modality, eps=config['adv_epsilon'], alpha=config['adv_alpha'], steps=config['adv_steps'], early_stop=config['adv_early_stop'], restarts=config['adv_restarts'], max_batch_size=config['adv_max_batch'])
+    elif attack_name == 'cw':
+        return CW(device=device, model=model, target_modality=target_modality, c_val=config['adv_epsilon'], kappa=config['adv_kappa'], learning_rate=config['adv_lr'], steps=config['adv_steps'], search_steps=config['adv_search_steps'], early_stop=config['adv_early_stop'])
+
+
 def setup_experiment(m_path, config, device, train=True):
     def setup_dataset(m_path, config, device, train):
         if config['dataset'] == 'mhd':
-            dataset = MhdDataset('mhd', os.path.join(m_path, "datasets", "mhd"), device, config['download'], config['exclude_modality'], config['target_modality'], train)
+            dataset = MhdDataset('mhd', os.path.join(m_path, "datasets", "mhd"), device, config['download'], config['exclude_modality'], config['target_modality'], train, storage=config['dataset_storage'], cache=config['dataset_cache'], modalities=DATASET_MODALITIES[config['dataset']], storage_dtype=config['dataset_dtype'], pin_memory=config['pin_memory'])
         elif config['dataset'] == 'mosi':
-            dataset = MosiDataset('mosi', os.path.join(m_path, "datasets", "mosi"), device, config['download'], config['exclude_modality'], config['target_modality'], train)
+            dataset = MosiDataset('mosi', os.path.join(m_path, "datasets", "mosi"), device, config['download'], config['exclude_modality'], config['target_modality'], train, storage=config['dataset_storage'], cache=config['dataset_cache'], modalities=DATASET_MODALITIES[config['dataset']], storage_dtype=config['dataset_dtype'], pin_memory=config['pin_memory'])
         elif config['dataset'] == 'mosei':
-            dataset = MoseiDataset('mosei', os.path.join(m_path, "datasets", "mosei"), device, config['download'], config['exclude_modality'], config['target_modality'], train)
+            dataset = MoseiDataset('mosei', os.path.join(m_path, "datasets", "mosei"), device, config['download'], config['exclude_modality'], config['target_modality'], train, storage=config['dataset_storage'], cache=config['dataset_cache'], modalities=DATASET_MODALITIES[config['dataset']], storage_dtype=config['dataset_dtype'], pin_memory=config['pin_memory'])
         elif config['dataset'] == 'pendulum':
-            dataset = PendulumDataset('pendulum', os.path.join(m_path, "datasets", "pendulum"), device, config['download'], config['exclude_modality'], config['target_modality'], train)
+            dataset = PendulumDataset('pendulum', os.path.join(m_path, "datasets", "pendulum"), device, config['download'], config['exclude_modality'], config['target_modality'], train, storage=config['dataset_storage'], cache=config['dataset_cache'], modalities=DATASET_MODALITIES[config['dataset']], storage_dtype=config['dataset_dtype'], pin_memory=config['pin_memory'])
         elif config['dataset'] == 'mnist_svhn':
-            dataset = MnistSvhnDataset('mnist_svhn', os.path.join(m_path, "datasets", "mnist_svhn"), device, config['download'], config['exclude_modality'], config['target_modality'], train)
+            dataset = MnistSvhnDataset('mnist_svhn', os.path.join(m_path, "datasets", "mnist_svhn"), device, config['download'], config['exclude_modality'], config['target_modality'], train, dm=config['data_multiplier'], storage=config['dataset_storage'], cache=config['dataset_cache'], modalities=DATASET_MODALITIES[config['dataset']], storage_dtype=config['dataset_dtype'], pin_memory=config['pin_memory'])
         return dataset
     
     def setup_classifier(model, latent_dim, exclude_mod):
@@ -133,9 +174,12 @@ def setup_experiment(m_path, config, device, train=True):
         model_config = json.load(open(os.path.join(m_path, "configs", "train_model", config['path_model'] + '.json')))
         latent_dim = model_config["latent_dimension"]
         exclude_modality = model_config["exclude_modality"]
+        # Models saved before the shared trunk option keep the joint processor's own stacks
+        shared_trunk = model_config.get("shared_trunk") or False
     else:
         latent_dim = config["latent_dimension"]
         exclude_modality = config["exclude_modality"]
+        shared_trunk = config.get("shared_trunk") or False
 
     if config['dataset'] == 'mhd':
         if config['architecture'] == 'vae':
@@ -160,7 +204,7 @@ def setup_experiment(m_path, config, device, train=True):
             scales = {'image': config['image_recon_scale'], 'trajectory': config['traj_recon_scale']}
             model = MHDCMDAE(config['architecture'], latent_dim, device, exclude_modality, scales, noise_factor=config['train_noise_factor'])
         elif config['architecture'] == 'gmc':
-            model = MHDGMC(config['architecture'], exclude_modality, config['common_dimension'], latent_dim, config['infonce_temperature'])
+            model = MHDGMC(config['architecture'], exclude_modality, config['common_dimension'], latent_dim, config['infonce_temperature'], infonce_block_size=config['infonce_block_size'], queue_size=config['gmc_queue_size'], queue_momentum=config['gmc_queue_momentum'], shared_trunk=shared_trunk)
         elif config['architecture'] == 'dgmc':
             scales = {'image': config['image_recon_scale'], 'trajectory': config['traj_recon_scale'], 'infonce_temp': config['infonce_temperature']}
             model = MHDDGMC(config['architecture'], exclude_modality, config['common_dimension'], latent_dim, scales, noise_factor=config['train_noise_factor'])
@@ -193,7 +237,7 @@ def setup_experiment(m_path, config, device, train=True):
             scales = {'mnist': config['mnist_recon_scale'], 'svhn': config['svhn_recon_scale']}
             model = MSCMDAE(config['architecture'], latent_dim, device, exclude_modality, scales, noise_factor=config['train_noise_factor'])
         elif config['architecture'] == 'gmc':
-            model = MSGMC(config['architecture'], exclude_modality, config['common_dimension'], latent_dim, config['infonce_temperature'])
+            model = MSGMC(config['architecture'], exclude_modality, config['common_dimension'], latent_dim, config['infonce_temperature'], infonce_block_size=config['infonce_block_size'], queue_size=config['gmc_queue_size'], queue_momentum=config['gmc_queue_momentum'], shared_trunk=shared_trunk)
         elif config['architecture'] == 'dgmc':
             scales = {'mnist': config['mnist_recon_scale'], 'svhn': config['svhn_recon_scale'], 'infonce_temp': config['infonce_temperature']}
             model = MSDGMC(config['architecture'], exclude_modality, config['common_dimension'], latent_dim, scales, noise_factor=config['train_noise_factor'])
@@ -249,9 +293,9 @@ def setup_experiment(m_path, config, device, train=True):
         else:
             gmc_config = json.load(open(os.path.join(m_path, "configs", "train_model", config['model_out'][5:] + '.json')))
         if config['dataset'] == 'mhd':
-            gmc_model = MHDGMC(gmc_config['architecture'], gmc_config['exclude_modality'], gmc_config['common_dimension'], gmc_config['latent_dimension'], gmc_config['infonce_temperature'])
+            gmc_model = MHDGMC(gmc_config['architecture'], gmc_config['exclude_modality'], gmc_config['common_dimension'], gmc_config['latent_dimension'], gmc_config['infonce_temperature'], shared_trunk=gmc_config.get('shared_trunk') or False)
         elif config['dataset'] == 'mnist_svhn':
-            gmc_model = MSGMC(gmc_config['architecture'], gmc_config['exclude_modality'], gmc_config['common_dimension'], gmc_config['latent_dimension'], gmc_config['infonce_temperature'])
+            gmc_model = MSGMC(gmc_config['architecture'], gmc_config['exclude_modality'], gmc_config['common_dimension'], gmc_config['latent_dimension'], gmc_config['infonce_temperature'], shared_trunk=gmc_config.get('shared_trunk') or False)
         elif config['dataset'] == 'mosei' or config['dataset'] == 'mosi':
             gmc_model = AffectGMC(gmc_config['architecture'], gmc_config['exclude_modality'], gmc_config['common_dimension'], gmc_config['latent_dimension'], gmc_config['infonce_temperature'])
 
@@ -274,7 +318,12 @@ def setup_experiment(m_path, config, device, train=True):
         attack = FGSM(device=device, model=clf_gmc_model, target_modality=None, eps=config['adv_std'])
         model.set_perturbation(attack)
 
-    if config['adversarial_attack'] is not None:
+    # FGSM and noise sweeps perturb the clean test set per batch for every sweep point instead of generating a single adversarial dataset
+    fgsm_sweep = config['stage'] == 'test_classifier' and config['adversarial_attack'] == 'fgsm' and config['adv_epsilons'] is not None
+    noise_sweep = config['stage'] == 'test_classifier' and config['adversarial_attack'] == 'gaussian_noise' and config['noise_stds'] is not None
+    # Attack ensembles generate their worst-case dataset when the classifier is tested
+    attack_ensemble = config['stage'] == 'test_classifier' and config['adv_ensemble'] is not None
+    if config['adversarial_attack'] is not None and not fgsm_sweep and not noise_sweep and not attack_ensemble:
         target_modality = config['target_modality']
         if config['stage'] == "inference":
             clf_config = json.load(open(os.path.join(m_path, "configs", "train_classifier", config['path_classifier'] + '.json')))
@@ -287,21 +336,17 @@ def setup_experiment(m_path, config, device, train=True):
         else:
             clf_model = model
 
-        if config['adversarial_attack'] == 'gaussian_noise':
-            attack = GaussianNoise(device=device, target_modality=target_modality, std=config['noise_std'])
-        elif config['adversarial_attack'] == 'fgsm':
-            attack = FGSM(device=device, model=clf_model, target_modality=target_modality, eps=config['adv_epsilon'])
-        elif config['adversarial_attack'] == 'bim':
-            attack = BIM(device=device, model=clf_model, target_modality=target_modality, eps=config['adv_epsilon'], alpha=config['adv_alpha'], steps=config['adv_steps'])
-        elif config['adversarial_attack'] == 'pgd':
-            attack = PGD(device=device, model=clf_model, target_modality=target_modality, eps=config['adv_epsilon'], alpha=config['adv_alpha'], steps=config['adv_steps'])
-        elif config['adversarial_attack'] == 'cw':
-            attack = CW(device=device, model=clf_model, target_modality=target_modality, c_val=config['adv_epsilon'], kappa=config['adv_kappa'], learning_rate=config['adv_lr'], steps=config['adv_steps'])
-
-        if "classifier" in config['stage'] or config['stage'] == 'train_supervised' or config['stage'] == 'inference':
-            dataset.dataset = attack(dataset.dataset, dataset.labels)
+        attack = setup_attack(config, device, clf_model, config['adversarial_attack'], target_modality)
+        use_labels = "classifier" in config['stage'] or config['stage'] == 'train_supervised' or config['stage'] == 'inference'
+        if config['adv_cache'] and config['adversarial_attack'] != 'gaussian_noise':
+            run_cached_attack(attack, dataset, train, use_labels, config['adv_chunk_size'], config['seed'], config['adv_workers'])
         else:
-            dataset.dataset = attack(dataset.dataset)
+            out_path = None
+            if config['adv_storage'] == 'mmap':
+                # Named after the attack cache key, so runs with other parameters, weights or seeds never share an output file
+                key, _ = get_attack_cache_key(attack, dataset, train, use_labels, config['adv_chunk_size'], config['seed'], config['adv_workers'])
+                out_path = os.path.join(dataset.dataset_dir, "adversarial", f"{config['adversarial_attack']}_{target_modality}_{'train' if train else 'test'}_{key}.npy")
+            run_attack_farm(attack, dataset, use_labels, config['adv_chunk_size'], config['adv_workers'], out_path, config['seed'])
 
     if train and config['stage'] != 'inference':
         if config['optimizer'] is not None:
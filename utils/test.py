@@ -6,6 +6,8 @@ import tracemalloc
 import matplotlib.pyplot as plt
 
 from tqdm import tqdm
+from data.transforms import FGSM, GaussianNoise, run_attack_ensemble
+from utils.setup import setup_dataloader, setup_attack, set_batch_padding
 from utils.logger import save_test_results, save_trajectory
 
 
@@ -17,7 +19,7 @@ def run_inference(m_path, config, device, model, dataset):
     with open(os.path.join(m_path, "results", config['path_model'] + ".txt"), 'a') as file:
         file.write('Performing inference:\n')
 
-    dataloader = iter(torch.utils.data.DataLoader(dataset, batch_size=1))
+    dataloader = setup_dataloader(config, dataset, 1)
     counter = 0
     tracemalloc.start()
     inference_start = time.time()
@@ -52,15 +54,17 @@ def run_inference(m_path, config, device, model, dataset):
 
 
 def run_test(m_path, config, device, model, dataset):
-    dataloader = iter(torch.utils.data.DataLoader(dataset, batch_size=config['batch_size'], shuffle=True, drop_last=True))
+    dataloader = setup_dataloader(config, dataset, config['batch_size'], shuffle=True, drop_last=True)
     test_bnumber = len(dataloader)
     loss_dict = collections.Counter(dict.fromkeys(dataset.dataset.keys(), 0.))
     tracemalloc.start()
     test_start = time.time()
     for batch_feats, batch_labels in tqdm(dataloader, total=test_bnumber):
+        set_batch_padding(model, dataloader)
         _, batch_loss_dict = model.validation_step(batch_feats, batch_labels)
 
         loss_dict = loss_dict + batch_loss_dict
+    set_batch_padding(model)
 
     for key in loss_dict.keys():
         loss_dict[key] = [loss_dict[key] / test_bnumber]
@@ -74,4 +78,81 @@ def run_test(m_path, config, device, model, dataset):
     with open(os.path.join(m_path, "results", config['stage'], config['model_out'] + ".txt"), 'a') as file:
         file.write(f'- Total runtime: {test_end - test_end} sec\n')
 
-    save_test_results(m_path, config, loss_dict)
\ No newline at end of file
+    save_test_results(m_path, config, loss_dict)
+
+
+def run_sweep(m_path, config, device, model, dataset, sweep_name, param_name, points, perturb):
+    # The clean features of the untouched modalities are computed once per batch and shared by every sweep point
+    dataloader = setup_dataloader(config, dataset, config['batch_size'])
+    loss_dict = {point: collections.Counter() for point in points}
+    n_samples = 0
+    sweep_start = time.time()
+    for batch_feats, batch_labels in tqdm(dataloader, total=len(dataloader)):
+        batch_size = len(batch_labels)
+        set_batch_padding(model, dataloader)
+        model.set_feature_cache(model.cache_features(batch_feats, config['target_modality']))
+        for point, adv_feats in perturb(batch_feats, batch_labels, points):
+            with torch.no_grad():
+                _, batch_loss_dict = model.validation_step(adv_feats, batch_labels)
+            loss_dict[point] = loss_dict[point] + collections.Counter({key: float(value) * batch_size for key, value in batch_loss_dict.items()})
+        model.set_feature_cache(None)
+        n_samples += batch_size
+    set_batch_padding(model)
+
+    sweep_end = time.time()
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+
+    metrics = sorted(loss_dict[points[0]].keys())
+    os.makedirs(os.path.join(m_path, "results", config['stage']), exist_ok=True)
+    with open(os.path.join(m_path, "results", config['stage'], config['model_out'] + f"_{sweep_name}_sweep.csv"), 'w') as file:
+        file.write(",".join([param_name] + metrics) + "\n")
+        for point in points:
+            file.write(",".join([f"{point}"] + [f"{loss_dict[point][key] / n_samples}" for key in metrics]) + "\n")
+
+    print(f"{sweep_name.upper()} sweep on {config['target_modality']} ({n_samples} samples, {len(points)} {param_name} values):")
+    print(param_name.ljust(10) + "".join(key.ljust(14) for key in metrics))
+    for point in points:
+        print(f"{point:<10}" + "".join(f"{loss_dict[point][key] / n_samples:<14.6f}" for key in metrics))
+    print(f'- Total runtime: {sweep_end - sweep_start} sec')
+
+
+def run_fgsm_sweep(m_path, config, device, model, dataset):
+    # One gradient per batch serves all epsilons, the perturbed inputs are produced lazily one epsilon at a time
+    attack = FGSM(device=device, model=model, target_modality=config['target_modality'])
+    attack._set_bounds(dataset._get_bounds(config['target_modality'], config['adv_chunk_size']))
+    run_sweep(m_path, config, device, model, dataset, "fgsm", "eps", sorted(config['adv_epsilons']), attack.sweep)
+
+
+def run_noise_sweep(m_path, config, device, model, dataset):
+    def perturb(batch_feats, batch_labels, stds):
+        for std in stds:
+            noise = GaussianNoise(device=device, target_modality=config['target_modality'], std=std)
+            noise._set_bounds(bounds)
+            yield std, noise(dict(batch_feats))
+
+    bounds = dataset._get_bounds(config['target_modality'], config['adv_chunk_size'])
+
+    run_sweep(m_path, config, device, model, dataset, "noise", "std", sorted(config['noise_stds']), perturb)
+
+
+def run_attack_ensemble_test(m_path, config, device, model, dataset):
+    attacks = [setup_attack(config, device, model, attack_name, config['target_modality']) for attack_name in config['adv_ensemble']]
+    stats = run_attack_ensemble(model, attacks, dataset, config['adv_chunk_size'])
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+
+    os.makedirs(os.path.join(m_path, "results", config['stage']), exist_ok=True)
+    with open(os.path.join(m_path, "results", config['stage'], config['model_out'] + "_attack_ensemble.csv"), 'w') as file:
+        file.write("attack,attacked,broken,robust_accuracy,time\n")
+        file.write(f"clean,0,0,{stats['clean_accuracy']},0.0\n")
+        for stage in stats['stages']:
+            file.write(f"{stage['attack']},{stage['attacked']},{stage['broken']},{stage['robust_accuracy']},{stage['time']}\n")
+
+    print(f"Attack ensemble on {config['target_modality']} ({stats['samples']} samples):")
+    print("attack".ljust(16) + "attacked".ljust(12) + "broken".ljust(12) + "robust acc".ljust(14) + "time (s)")
+    print("clean".ljust(16) + "-".ljust(12) + "-".ljust(12) + f"{stats['clean_accuracy']:<14.6f}" + "-")
+    for stage in stats['stages']:
+        print(f"{stage['attack']:<16}{stage['attacked']:<12}{stage['broken']:<12}{stage['robust_accuracy']:<14.6f}{stage['time']:.2f}")
+    print(f"- Overall robust accuracy: {stats['robust_accuracy']}")
+    print(f"- Total runtime: {stats['time']} sec")
@@ -7,6 +7,7 @@ import collections
 import tracemalloc
 
 from tqdm import tqdm
+from utils.setup import setup_dataloader, set_batch_padding
 from utils.logger import save_epoch_results, save_train_results
 
 
@@ -43,13 +44,15 @@ def run_train_epoch(m_path, epoch, config, device, model, train_set, train_losse
         file.write('Training:\n')
 
     loss_dict = collections.Counter(dict.fromkeys(train_losses.keys(), 0.))
-    train_loader = iter(torch.utils.data.DataLoader(train_set, batch_size=config['batch_size'], shuffle=True, drop_last=True))
+    train_loader = setup_dataloader(config, train_set, config['batch_size'], shuffle=True, drop_last=True)
     train_bnumber = len(train_loader)
     run_start = time.time()
     for batch_feats, batch_labels in tqdm(train_loader, total=train_bnumber):
         if config['optimizer'] is not None:
             optimizer.zero_grad()
 
+        set_batch_padding(model, train_loader)
+
         loss, batch_loss_dict = model.training_step(batch_feats, batch_labels)
         loss_dict = loss_dict + batch_loss_dict
 
@@ -59,6 +62,7 @@ def run_train_epoch(m_path, epoch, config, device, model, train_set, train_losse
 
         if 'wandb' in config and config['wandb']:
             wandb.log({**batch_loss_dict})
+    set_batch_padding(model)
 
     for key, value in loss_dict.items():
         loss_dict[key] = value / train_bnumber